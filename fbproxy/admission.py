@@ -0,0 +1,179 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Admission control for requests to the Graph API server.
+
+When the Graph API slows down or starts throttling us, firing more requests at
+it only makes things worse. The AdmissionController bounds the number of
+upstream requests in flight, both globally and per app. The bounds adapt
+(additive increase, multiplicative decrease): every fast, successful response
+raises them a little, and every slow or throttled response halves them.
+Requests waiting for a slot are served cache fills first, and give up once
+their queue deadline passes.
+
+The controller in use is stored in `controller`. It is None (no admission
+control) unless the launcher configures one.
+"""
+import json
+import threading
+import time
+import logging
+
+
+controller = None
+
+# Graph API error codes which mean we are being rate limited
+THROTTLE_CODES = set([4, 17, 32, 341, 613])
+
+
+class UpstreamRejected(Exception):
+    """ Raised when a request is not admitted before its queue deadline."""
+
+
+class AimdLimit(object):
+    """ A concurrency limit adjusted by additive increase/multiplicative
+    decrease.
+    """
+    def __init__(self, maximum, minimum=1, backoff=0.5, cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.inflight = 0
+        self.last_cut = 0
+
+    def available(self):
+        return self.inflight < int(self.limit)
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self, now):
+        # one burst of slow responses should only cut the limit once
+        if now - self.last_cut >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self.last_cut = now
+
+
+class AdmissionController(object):
+    """ Bounds concurrent upstream requests globally and per app.
+
+    Call acquire() before sending a request, and release() with its outcome
+    once the response has been read.
+    """
+    def __init__(self, global_limit, app_limit=None, min_limit=1,
+                 latency_target=1.0, queue_timeout=1.0, backoff=0.5,
+                 reject_status='503 Service Unavailable'):
+        self.total = AimdLimit(global_limit, min_limit, backoff)
+        self.app_limit = app_limit
+        self.min_limit = min_limit
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+        self.reject_status = reject_status
+        self.apps = {}
+        self.waiting_fills = 0
+        self.cond = threading.Condition()
+
+    def _limits(self, app_id):
+        limits = [self.total]
+        if self.app_limit and app_id:
+            if not app_id in self.apps:
+                self.apps[app_id] = AimdLimit(self.app_limit, self.min_limit,
+                                              self.backoff)
+            limits.append(self.apps[app_id])
+        return limits
+
+    def acquire(self, app_id=None, fill=False):
+        """ Wait for a slot. Returns the start time to pass to release().
+
+        fill should be True for cache fills, which are admitted ahead of
+        pass-through requests. Raises UpstreamRejected if no slot frees up
+        within the queue timeout.
+        """
+        deadline = time.time() + self.queue_timeout
+        self.cond.acquire()
+        try:
+            limits = self._limits(app_id)
+            if fill:
+                self.waiting_fills += 1
+            try:
+                while not (all(x.available() for x in limits) and
+                           (fill or not self.waiting_fills)):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logging.warning('rejecting upstream request for app '
+                                        + str(app_id) + ': queue timeout')
+                        raise UpstreamRejected()
+                    self.cond.wait(remaining)
+            finally:
+                if fill:
+                    self.waiting_fills -= 1
+            for limit in limits:
+                limit.inflight += 1
+        finally:
+            self.cond.release()
+        return time.time()
+
+    def try_acquire(self, app_id=None):
+        """ Take a slot only if one is free right away, without queueing.
+
+        Returns the start time to pass to release(), or None.
+        """
+        self.cond.acquire()
+        try:
+            limits = self._limits(app_id)
+            if self.waiting_fills or not all(x.available() for x in limits):
+                return None
+            for limit in limits:
+                limit.inflight += 1
+        finally:
+            self.cond.release()
+        return time.time()
+
+    def release(self, app_id, started, status, body, cancelled=False):
+        """ Return a slot, adjusting the limits from the response.
+
+        status should be None if the request failed without a response. A
+        request we cancelled ourselves frees its slot without adjusting them.
+        """
+        now = time.time()
+        overloaded = (status is None or now - started > self.latency_target or
+                      is_throttled(status, body))
+        self.cond.acquire()
+        for limit in self._limits(app_id):
+            limit.inflight -= 1
+            if cancelled:
+                pass
+            elif overloaded:
+                limit.on_overload(now)
+            else:
+                limit.on_success()
+        self.cond.notify_all()
+        self.cond.release()
+
+
+def is_throttled(status, body):
+    """ Whether a Graph API response indicates we are being throttled."""
+    if status == 200:
+        return False
+    if status == 503:
+        return True
+    try:
+        error = json.loads(body).get('error', {})
+        return error.get('code') in THROTTLE_CODES
+    except (ValueError, AttributeError):
+        return False
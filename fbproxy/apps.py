@@ -39,6 +39,8 @@ class App(object):
         self.bad_conns = set()
         self.good_fields = set()
         self.good_conns = set()
+        self.shared_fields = set()
+        self.shared_conns = set()
         self.users = set()
         self.lock = threading.Lock()
         self.cred = config.get('app_cred')
@@ -53,6 +55,18 @@ class App(object):
             self.good_conns = set(config['whitelist_connections'])
         self.good_fields -= self.bad_fields
         self.good_conns -= self.bad_conns
+        if 'shared_fields' in config:
+            self.shared_fields = set(config['shared_fields']) & \
+                    self.good_fields
+        if 'shared_connections' in config:
+            self.shared_conns = set(config['shared_connections']) & \
+                    self.good_conns
+
+    def policy(self):
+        """ The settings which decide what is cached and subscribed to."""
+        return (self.good_fields, self.good_conns, self.bad_fields,
+                self.bad_conns, self.shared_fields, self.shared_conns,
+                self.cred, self.secret)
 
     def check_user(self, requestor, requestee, default=None):
         """ Check a request's users.
@@ -86,6 +100,19 @@ class App(object):
         return False  # safety: if we're not certain about it, fall back to
                       # passthrough behavior
 
+    def is_shared(self, pathparts, fields=None):
+        """ Returns whether a request's response is the same for all viewers.
+
+        This is the case for requests for only shared_fields of a user (the
+        fields must be explicitly listed) and for shared_connections. Such
+        responses are cached once for all viewers of the app.
+        """
+        if len(pathparts) == 1:
+            return bool(fields) and set(fields) <= self.shared_fields
+        elif len(pathparts) == 2:
+            return pathparts[1] in self.shared_conns
+        return False
+
 
 def init(configapps):
     """ Initializes the mapping of app ids to the App objects from config"""
@@ -98,10 +125,36 @@ def init(configapps):
                                                      in apps.itervalues()])
         default_app.good_conns = reduce(intersect, [x.good_conns for x in
                                                     apps.itervalues()])
+        default_app.shared_fields = reduce(intersect, [x.shared_fields for x
+                                                       in apps.itervalues()])
+        default_app.shared_conns = reduce(intersect, [x.shared_conns for x
+                                                      in apps.itervalues()])
         apps['default'] = default_app
     return apps
 
 
+def reload(old_apps, configapps):
+    """ Re-initializes the app mapping, carrying over state from old_apps.
+
+    Returns (apps, changed), where changed maps the id of every app which is
+    new, removed or whose policy differs to its old App object (None for new
+    apps). The known users of every app are carried over.
+    """
+    new_apps = init(configapps)
+    changed = {}
+    for (app_id, app) in new_apps.iteritems():
+        old = old_apps.get(app_id)
+        if old:
+            old.lock.acquire()
+            app.users = set(old.users)
+            old.lock.release()
+        if not old or old.policy() != app.policy():
+            changed[app_id] = old
+    for app_id in set(old_apps) - set(new_apps):
+        changed[app_id] = old_apps[app_id]
+    return (new_apps, changed)
+
+
 def get_app(app_id, app_set):
     """Look up the given app in the app_set, using the default if needed."""
     if app_id in app_set:
@@ -18,13 +18,126 @@ import urllib
 import json
 import threading
 import logging
-from fbproxy.lru import LRU
+from fbproxy.lru import POLICIES
 from fbproxy.requesthandler import ProxyRequestHandler
 from fbproxy.hashdict import HashedDictionary
 
 
 SCALAR_TABLE = 1
 VECTOR_TABLE = 2
+# the most objects of a connection which are fetched and cached
+LIST_LIMIT = 5000
+
+
+def key_uid(key):
+    """ The id of the user whose data a cache key (path + "__" + appid) is."""
+    return key.rsplit('__', 1)[0].split('/', 1)[0]
+
+
+class UserIndex(object):
+    """ Maps user ids to the keys of all their cache entries.
+
+    One index is shared by all partitions of a cache, so that the entries
+    of a user can be found for every app without scanning the cache.
+    """
+    def __init__(self):
+        self.keys = {}
+
+    def add(self, key):
+        self.keys.setdefault(key_uid(key), set()).add(key)
+
+    def discard(self, key):
+        uid = key_uid(key)
+        keys = self.keys.get(uid)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self.keys[uid]
+
+    def get(self, uid):
+        """ Returns a list of the keys of uid's entries."""
+        return list(self.keys.get(uid, ()))
+
+
+class CachePartition(object):
+    """ The slice of the cache belonging to one application.
+
+    Each partition keeps its own LRU of path keys. `entries` and `max_bytes`
+    are the partition's reserved quota; anything it holds beyond that is
+    borrowed from the shared overflow pool of the owning ProxyLruCache. Keys
+    are added to and removed from `index`, a UserIndex, as entries come and
+    go.
+    """
+    def __init__(self, name, entries=0, max_bytes=0, policy='lru',
+                 index=None):
+        self.name = name
+        self.entries = entries
+        self.max_bytes = max_bytes
+        self.index = index if index is not None else UserIndex()
+        self.lru = POLICIES[policy](None)
+        self.charged = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def borrowed_entries(self):
+        """ The number of entries held beyond the reserved quota."""
+        return max(0, self.lru.count - self.entries)
+
+    def borrowed_bytes(self):
+        """ The number of bytes held beyond the reserved quota."""
+        return max(0, self.bytes - self.max_bytes)
+
+    def insert(self, key, hashdict, oldest=False):
+        """ Add a fresh HashedDictionary for key to this partition.
+
+        It becomes the most recently used entry, or the least recently used
+        one if oldest is set.
+        """
+        self.remove(key)
+        if oldest:
+            self.lru.append(key, hashdict)
+        else:
+            self.lru[key] = hashdict
+        self.charged[key] = 0
+        self.index.add(key)
+
+    def charge(self, key, hashdict):
+        """ Update the byte accounting for key after hashdict has grown."""
+        if self.lru.peek(key) is not hashdict:
+            return  # evicted or replaced while we were fetching
+        self.bytes += hashdict.nbytes - self.charged[key]
+        self.charged[key] = hashdict.nbytes
+
+    def remove(self, key):
+        """ Drop key from this partition. Does nothing if it is missing."""
+        if key in self.lru:
+            self.lru.peek(key).release()
+            del self.lru[key]
+            self.bytes -= self.charged.pop(key)
+            self.index.discard(key)
+
+    def evict(self):
+        """ Drop the least-recently-used entry of this partition."""
+        (key, hashdict) = self.lru.popoldest()
+        hashdict.release()
+        self.bytes -= self.charged.pop(key)
+        self.index.discard(key)
+        self.evictions += 1
+        return (key, hashdict)
+
+    def stats(self):
+        """ Returns occupancy and hit-rate figures for this partition."""
+        lookups = self.hits + self.misses
+        return {'entries': self.lru.count,
+                'bytes': self.bytes,
+                'quota_entries': self.entries,
+                'quota_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions}
 
 
 class ProxyLruCache(object):
@@ -36,12 +149,80 @@ class ProxyLruCache(object):
     `width` views of this URL are stored (again in an LRU). Finally, underneath
     this is a mapping from access-token-less query strings to results.
 
+    The top tier is split into per-app CachePartitions. `quotas` maps app ids
+    to (entries, bytes) reservations; apps without one share the 'shared'
+    partition. `size` and `max_bytes` bound the overflow pool which all
+    partitions may borrow from once their own quota is used up. When space is
+    needed, entries are only ever evicted from the partition that needs it.
+    `policy` picks the eviction order within partitions ('lru' or 'fifo').
+    If a SlabArena is given, responses stored as they are and the bodies
+    rendered from tables on hits are kept in it.
+
+    Connections are fetched and stored whole (up to list_limit objects), as
+    parsed lists. Requests for a page of a connection, or for some fields of
+    its objects, are served from that one list. Requests without a limit get
+    the Graph API's own default page and paging links, so their responses
+    are stored as they are, under a subkey of their own.
+
+    While a snapshot (see fbproxy.snapshot) is being loaded by warm(), its
+    entries are also restored as soon as they are requested, and
+    invalidations apply to the entries still in it.
+
+    The keys of each user's entries are indexed across partitions, so
+    invalidate_user can drop them all without scanning the cache.
+
     This implementation can be replaced. The relevant functions to implement
-    are handle_request and invalidate.
+    are handle_request, invalidate and invalidate_user.
     """
-    def __init__(self, size):
-        self.cache = LRU(size)
+    def __init__(self, size, max_bytes=None, quotas=None, policy='lru',
+                 arena=None, list_limit=LIST_LIMIT):
+        self.overflow_entries = size
+        self.overflow_bytes = max_bytes
+        self.partitions = {}
+        self.users = UserIndex()
+        if quotas:
+            for (appid, (entries, nbytes)) in quotas.iteritems():
+                self.partitions[appid] = CachePartition(appid, entries,
+                                                        nbytes, policy,
+                                                        self.users)
+        self.shared = CachePartition('shared', policy=policy,
+                                     index=self.users)
         self.lock = threading.Lock()
+        self.arena = arena
+        self.list_limit = list_limit
+        # the snapshot being loaded, if any
+        self.snapshot = None
+        # how cache misses are fetched. the replay tool swaps this out
+        self.fetch = fetch_tuple
+
+    def partition(self, appid):
+        """ Returns the CachePartition responsible for the given app id."""
+        return self.partitions.get(appid, self.shared)
+
+    def _all_partitions(self):
+        return self.partitions.values() + [self.shared]
+
+    def _overfull(self, part):
+        """ Whether part has to give up an entry to respect the quotas."""
+        if part.lru.count > part.entries and self.overflow_entries is not None:
+            borrowed = sum(x.borrowed_entries() for x in
+                           self._all_partitions())
+            if borrowed > self.overflow_entries:
+                return True
+        if part.bytes > part.max_bytes and self.overflow_bytes is not None:
+            borrowed = sum(x.borrowed_bytes() for x in self._all_partitions())
+            if borrowed > self.overflow_bytes:
+                return True
+        return False
+
+    def _make_room(self, part):
+        """ Evict from part until the pool is back within its limits.
+
+        The caller must hold self.lock.
+        """
+        while part.lru.count and self._overfull(part):
+            (key, _) = part.evict()
+            logging.debug('evicting ' + key + ' from partition ' + part.name)
 
     def handle_request(self, query, path, querystring, app, server):
         """ handle a cacheable request. returns (status, headers, data) tuple.
@@ -63,40 +244,90 @@ class ProxyLruCache(object):
         usetable = '/' not in path  # use table for user directly
         # usetable = False
         fields = None
-        if 'fields' in query and usetable:
+        if 'fields' in query:
             fields = query['fields'][0]
             del query['fields']
+        page = None
+        if not usetable:  # connections are stored whole, and paged here
+            page = _page_params(query)
+            if not page:
+                return self.fetch(path, querystring, server, app.id)[:3]
+        raw = page is not None and page[1] is None
 
+        # viewer-independent responses are stored once for all viewers
+        shared = app.is_shared(path.split('/'),
+                               fields.split(',') if fields else None)
         key = path + "__" + appid
-        subkey = uid + "__" + urllib.urlencode(query)
+        subkey = ('*' if shared else uid) + "__" + urllib.urlencode(query)
+        if raw:
+            subkey += "__raw__%d__%s" % (page[0], fields or '')
+        elif fields and not usetable:
+            # lists fetched with explicit fields grow to cover all requested
+            subkey += "__fields"
+        # the fields a table is fetched with
+        covered = set(app.shared_fields if shared else app.good_fields)
         value = None
+        stored = None  # a connection list too short for this request
+        base = None  # a table of which only the `stale` fields are refetched
+        stale = None
         hashdict = None
+        part = self.partition(appid)
         logging.debug('cache handling request with key ' + key +
                       ', and subkey ' + subkey + ' for user ' + uid)
 
         self.lock.acquire()
-        if key in self.cache:
-            # step 1. acquire the dictionary
-            hashdict = self.cache[key]
-            if subkey in hashdict:  # step 2: grab the relevant data if there
-                value = hashdict[subkey]
-        else:
-            hashdict = HashedDictionary()
-            self.cache[key] = hashdict
-        self.lock.release()
+        try:
+            if self.snapshot and key not in part.lru:
+                self._restore(part, key)
+            if key in part.lru:
+                # step 1. acquire the dictionary
+                hashdict = part.lru[key]
+                if subkey in hashdict:  # step 2: grab the data if there
+                    (value, valhash) = hashdict.lookup(subkey)
+                    if raw:
+                        pass
+                    elif page and not _covers(value[2], fields, page):
+                        (stored, value) = (value[2], None)
+                    elif usetable:
+                        stale = hashdict.stale_fields(subkey) & covered
+                        if stale and (not fields or
+                                      stale & set(fields.split(','))):
+                            (base, value) = (value[2], None)
+            else:
+                hashdict = HashedDictionary(self.arena)
+                part.insert(key, hashdict)
+                self._make_room(part)
+            marks = hashdict.marks
+            if value:
+                part.hits += 1
+            else:
+                part.misses += 1
+        finally:
+            self.lock.release()
 
         if value:  # step 3: return the data if available
-            if usetable:
+            if raw:
+                return value
+            elif usetable:
                 (statusline, headers, table) = value
-                return (statusline, headers, get_response(table, fields))
+                body = hashdict.rendered_body(valhash, fields)
+                if body is None:
+                    body = get_response(table, fields)
+                    hashdict.keep_rendered(valhash, fields, body)
+                return (statusline, headers, body)
             else:
-                return value
+                (statusline, headers, connlist) = value
+                return (statusline, headers, get_page(connlist, fields, page,
+                        path, query, accesstoken, server))
 
         # at this point, we have a cache miss
         # step 4: fetch data
         if usetable:
+            if base is not None:  # only some fields changed
+                covered = stale
             (statusline, headers, table, status) = _fetchtable(query,
-                    path, accesstoken, app, hashdict, subkey, server)
+                    path, accesstoken, app, hashdict, subkey, server,
+                    sorted(covered), self.fetch, base)
             # step 4.5: form a response body from the table
             if status != 200:
                 # fetchtable returns body instead of table on error
@@ -107,13 +338,125 @@ class ProxyLruCache(object):
                         headers.remove(header)
                         break
                 body = get_response(table, fields)
-        else:
-            (statusline, headers, body, status) = fetch_tuple(path,
-                    querystring, server)
+        elif raw:
+            (statusline, headers, body, status) = self.fetch(path,
+                    querystring, server, app.id)
             if status == 200:
-                hashdict[subkey] = ((statusline, headers, body), body)
+                hashdict.store(subkey, body,
+                               lambda: (statusline, headers, body))
+        else:
+            if stored and _beyond(stored, page):
+                # a page beyond the objects we fetch, however we fetch them
+                return self.fetch(path, querystring, server, app.id)[:3]
+            wanted = fields.split(',') if fields else None
+            if wanted and stored:  # refetch the fields already stored, too
+                wanted = sorted(set(wanted) | set(stored[0] or ()))
+            (statusline, headers, connlist, status) = _fetchlist(query, path,
+                    accesstoken, app, hashdict, subkey, server, wanted,
+                    self.list_limit, self.fetch)
+            if status != 200:
+                body = connlist
+            elif connlist is None or not _covers(connlist, fields, page):
+                # not a list, or longer than we fetch: serve this page as is
+                return self.fetch(path, querystring, server, app.id)[:3]
+            else:
+                headers = [x for x in headers
+                           if x[0].upper() != 'CONTENT-LENGTH']
+                body = get_page(connlist, fields, page, path, query,
+                                accesstoken, server)
+        if status == 200:
+            self.lock.acquire()
+            try:
+                if usetable:
+                    hashdict.refreshed(subkey, covered, marks,
+                                       base is not None)
+                part.charge(key, hashdict)
+                self._make_room(part)
+            finally:
+                self.lock.release()
         return (statusline, headers, body)
 
+    def _restore(self, part, key, oldest=False):
+        """ Move key from the snapshot into part, if the snapshot has it.
+
+        Returns whether the entry was restored. The caller must hold
+        self.lock.
+        """
+        hashdict = self.snapshot.take(key, self.arena)
+        if not hashdict:
+            return False
+        if key in part.lru:  # cached again since the start
+            hashdict.release()
+            return False
+        part.insert(key, hashdict, oldest)
+        part.charge(key, hashdict)
+        if not oldest:
+            self._make_room(part)
+        elif self._overfull(part):
+            part.remove(key)
+            return False
+        return True
+
+    def restore(self, key):
+        """ Move key from the snapshot being loaded into the cache.
+
+        The entry becomes the oldest of its partition, so that it is never
+        preferred over entries cached since the start. Returns whether the
+        entry was restored.
+        """
+        self.lock.acquire()
+        try:
+            if not self.snapshot:
+                return False
+            return self._restore(self.partition(key.rsplit('__', 1)[1]),
+                                 key, True)
+        finally:
+            self.lock.release()
+
+    def warm(self, snapshot):
+        """ Load the entries of a snapshot.Snapshot into the cache.
+
+        Entries are restored in the order of the snapshot, most recently used
+        first, until the cache is full. Returns the number restored.
+        """
+        self.lock.acquire()
+        try:
+            self.snapshot = snapshot
+        finally:
+            self.lock.release()
+        restored = 0
+        try:
+            for key in snapshot.keys():
+                if self.snapshot is not snapshot:
+                    break  # the cache was cleared
+                if self.restore(key):
+                    restored += 1
+        finally:
+            self.lock.acquire()
+            try:
+                if self.snapshot is snapshot:
+                    self.snapshot = None
+            finally:
+                self.lock.release()
+        return restored
+
+    def entries(self):
+        """ Returns a list of (key, HashedDictionary) for every entry.
+
+        Within each partition, the most recently used entries come first.
+        """
+        ret = []
+        self.lock.acquire()
+        try:
+            for part in self._all_partitions():
+                node = part.lru.head
+                while node:
+                    ret.append((node.key, node.value))
+                    node = node.successor
+        finally:
+            self.lock.release()
+        return ret
+
     def invalidate(self, appid, url):
         """ Invalidate a URL in an application's context.
 
@@ -122,13 +465,110 @@ class ProxyLruCache(object):
         key = url + "__" + appid
         logging.debug('invalidating' + key)
         self.lock.acquire()
-        if key in self.cache:
-            del self.cache[key]
-        # also invalidate the URL for the null app
-        key = url + "__0"
-        if key in self.cache:
-            del self.cache[key]
-        self.lock.release()
+        try:
+            self.partition(appid).remove(key)
+            # also invalidate the URL for the null app
+            self.partition('0').remove(url + "__0")
+            if self.snapshot:
+                self.snapshot.discard(key)
+                self.snapshot.discard(url + "__0")
+        finally:
+            self.lock.release()
+
+    def invalidate_user(self, uid, paths=None):
+        """ Invalidate a user's entries for every app.
+
+        paths, if given, limits this to the given paths (the user's id for
+        the user table, or uid/connection). Otherwise all entries for the
+        user go. Returns the number of entries removed.
+        """
+        logging.debug('invalidating entries for user ' + uid)
+        removed = 0
+        self.lock.acquire()
+        try:
+            for key in self.users.get(uid):
+                (path, appid) = key.rsplit('__', 1)
+                if paths is None or path in paths:
+                    self.partition(appid).remove(key)
+                    removed += 1
+            if self.snapshot:
+                self.snapshot.discard_user(uid, paths)
+        finally:
+            self.lock.release()
+        return removed
+
+    def invalidate_fields(self, uid, fields):
+        """ Mark fields of a user's tables stale, for every app.
+
+        Requests which avoid the stale fields are still served from the
+        tables. Other requests fetch only the stale fields, and merge them
+        into the table. Returns the number of tables affected.
+        """
+        logging.debug('invalidating fields ' + ','.join(fields) +
+                      ' for user ' + uid)
+        marked = 0
+        self.lock.acquire()
+        try:
+            for key in self.users.get(uid):
+                (path, appid) = key.rsplit('__', 1)
+                if path == uid:
+                    self.partition(appid).lru.peek(key).mark_stale(fields)
+                    marked += 1
+            if self.snapshot:
+                self.snapshot.discard_user(uid, [uid])
+        finally:
+            self.lock.release()
+        return marked
+
+    def invalidate_where(self, predicate):
+        """ Invalidate every entry for which predicate(path, appid) is true.
+
+        This scans the whole cache, so it is meant for rare events such as
+        configuration reloads. Returns the number of entries removed.
+        """
+        removed = 0
+        self.lock.acquire()
+        try:
+            for part in self._all_partitions():
+                for key in part.lru.index.keys():
+                    (path, appid) = key.rsplit('__', 1)
+                    if predicate(path, appid):
+                        part.remove(key)
+                        removed += 1
+            if self.snapshot:
+                self.snapshot.discard_where(predicate)
+        finally:
+            self.lock.release()
+        return removed
+
+    def clear(self):
+        """ Drop every entry from the cache."""
+        self.lock.acquire()
+        try:
+            for part in self._all_partitions():
+                while part.lru.count:
+                    part.evict()
+            self.snapshot = None
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Returns a dictionary of per-partition occupancy and hit rates."""
+        self.lock.acquire()
+        try:
+            ret = dict((x.name, x.stats()) for x in self._all_partitions())
+            ret['overflow'] = {
+                'entries': sum(x.borrowed_entries() for x in
+                               self._all_partitions()),
+                'bytes': sum(x.borrowed_bytes() for x in
+                             self._all_partitions()),
+                'max_entries': self.overflow_entries,
+                'max_bytes': self.overflow_bytes}
+        finally:
+            self.lock.release()
+        if self.arena:
+            ret['arena'] = self.arena.stats()
+        return ret
 
 
 def _response_to_table(body):
@@ -159,35 +599,171 @@ def get_response(table, fields):
     return json.dumps(ret)
 
 
-def _fetchtable(query, path, accesstoken, app, hashdict, key, server):
+def _page_params(query):
+    """ Removes offset and limit from query, returning (offset, limit).
+
+    limit is None if not given. Returns None if either is not a valid number.
+    """
+    try:
+        offset = int(query.pop('offset', ['0'])[0])
+        limit = query.pop('limit', [None])[0]
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return None
+    if offset < 0 or (limit is not None and limit < 0):
+        return None
+    return (offset, limit)
+
+
+def _response_to_list(body):
+    """ Parses a connection response into (complete, objects).
+
+    complete is False if the Graph API had more objects than it returned.
+    Returns None if the body is not a list of objects.
+    """
+    try:
+        bodyjson = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(bodyjson, dict) or \
+            not isinstance(bodyjson.get('data'), list):
+        return None
+    paging = bodyjson.get('paging')
+    complete = not (isinstance(paging, dict) and paging.get('next'))
+    return (complete, bodyjson['data'])
+
+
+def _has_fields(connlist, fields):
+    """ Whether a stored connection list has the requested fields."""
+    stored_fields = connlist[0]
+    return not fields or (stored_fields is not None and
+                          set(fields.split(',')) <= set(stored_fields))
+
+
+def _beyond(connlist, page):
+    """ Whether a page reaches past the objects of a truncated list."""
+    (_, complete, objects) = connlist
+    (offset, limit) = page
+    return not complete and (limit is None or offset + limit > len(objects))
+
+
+def _covers(connlist, fields, page):
+    """ Whether a stored connection list can serve a request."""
+    return _has_fields(connlist, fields) and not _beyond(connlist, page)
+
+
+def get_page(connlist, fields, page, path, query, accesstoken, server):
+    """ Renders a page of a stored connection list as Graph API JSON.
+
+    Only the given fields (and the id) of each object are included, if
+    fields are given. Paging links are built like the Graph API's own.
+    """
+    (_, complete, objects) = connlist
+    (offset, limit) = page
+    end = offset + limit if limit is not None else len(objects)
+    data = objects[offset:end]
+    if fields:
+        wanted = set(fields.split(',')) | set(['id'])
+        data = [dict((k, v) for (k, v) in x.iteritems() if k in wanted)
+                if isinstance(x, dict) else x for x in data]
+    ret = {'data': data}
+    paging = {}
+    params = dict(query)
+    if accesstoken:
+        params['access_token'] = accesstoken
+    if fields:
+        params['fields'] = fields
+    size = limit if limit is not None else len(data)
+    if offset > 0 and limit is not None:
+        params.update(limit=limit, offset=max(0, offset - limit))
+        paging['previous'] = _graph_url(server, path, params)
+    if end < len(objects) or not complete:
+        params.update(limit=size, offset=end)
+        paging['next'] = _graph_url(server, path, params)
+    if paging:
+        ret['paging'] = paging
+    return json.dumps(ret)
+
+
+def _graph_url(server, path, params):
+    return 'https://' + server + '/' + path + '?' + \
+            urllib.urlencode(sorted(params.items()), True)
+
+
+def _fetchlist(query, path, accesstoken, app, hashdict, key, server,
+               fields=None, limit=LIST_LIMIT, fetch=None):
+    """ Fetches a whole connection, returning it as a stored list.
+
+    The list is (fields, complete, objects), where fields are those the
+    objects were fetched with (None for the Graph API's default ones), and
+    complete is False if the connection has more than limit objects. It is
+    stored in the hash dict under key. The list is None if the response was
+    not a list.
+    """
+    params = dict(query)
+    params['limit'] = limit
+    if fields:
+        params['fields'] = ','.join(fields)
+    if accesstoken:
+        params['access_token'] = accesstoken
+    if not fetch:
+        fetch = fetch_tuple
+    (statusline, headers, data, statuscode) = fetch(path,
+            urllib.urlencode(params, True), server, app.id)
+    # error = send the raw response instead of a list
+    if statuscode != 200:
+        return (statusline, headers, data, statuscode)
+    parsed = _response_to_list(data)
+    if parsed is None:
+        return (statusline, headers, None, 200)
+    stored_fields = tuple(sorted(fields)) if fields else None
+    # the same body fetched with other fields is a different list
+    valhashed = ','.join(stored_fields) + '\0' + data if fields else data
+    hashdict.store(key, valhashed, lambda: (statusline, headers,
+                                            (stored_fields,) + parsed))
+    return (statusline, headers, hashdict[key][2], 200)
+
+
+def _fetchtable(query, path, accesstoken, app, hashdict, key, server,
+                fields=None, fetch=None, base=None):
     """ Fetches the requested object, returning it as a field-value table.
 
-    In addition, it will make use of the hash dict to avoid parsing the
-    body if possible (and store the response there as appropriate.
+    The table holds the given fields, or all of the app's good_fields. In
+    addition, it will make use of the hash dict to avoid parsing the
+    body if possible (and store the response there as appropriate. If base
+    is given, only the given fields are fetched, and merged into a copy of
+    the base table.
     """
-    fields = ','.join(app.good_fields)
+    fields = ','.join(fields if fields is not None else app.good_fields)
     query['fields'] = fields
     query['access_token'] = accesstoken
-    (statusline, headers, data, statuscode) = fetch_tuple(path, \
-            urllib.urlencode(query), server)
+    if not fetch:
+        fetch = fetch_tuple
+    (statusline, headers, data, statuscode) = fetch(path, \
+            urllib.urlencode(query), server, app.id)
     # error = send the raw response instead of a table
     if statuscode != 200:
         return (statusline, headers, data, statuscode)
-    # hash miss = have to parse the file
-    elif not hashdict.contains_hash(data):
-        hashdict[key] = ((statusline, headers, _response_to_table(data)), data)
-    else:  # statuscode == 200 and hashdict has the hash of the data
-        hashdict[key] = (None, data)  # the stored data arg is ignored
-                                      # since the hash is in the dict
+    if base is not None:
+        fresh = _response_to_table(data)
+        table = dict(base)
+        for field in fields.split(','):
+            if field in fresh:
+                table[field] = fresh[field]
+            else:  # the Graph API leaves out empty fields
+                table.pop(field, None)
+        # the merged table is identified by the base table and the new fields
+        hashdict.store(key, hashdict.hash_of(key) + data,
+                       lambda: (statusline, headers, table))
+    else:
+        # only a hash miss has to parse the file
+        hashdict.store(key, data,
+                       lambda: (statusline, headers, _response_to_table(data)))
     (statusline, headers, table) = hashdict[key]
     return (statusline, headers, table, 200)
 
 
-def fetch_tuple(path, querystring, server):
+def fetch_tuple(path, querystring, server, app_id=None):
     """ Fetches the requested object as (status, headers, body, status num)"""
-    response = ProxyRequestHandler.fetchurl('GET', path, querystring, server)
-    statusline = str(response.status) + " " + response.reason
-    headers = response.getheaders()
-    body = response.read()
-    response.close()
-    return (statusline, headers, body, response.status)
+    return ProxyRequestHandler.fetch('GET', path, querystring, server, app_id,
+                                     fill=True)
@@ -0,0 +1,155 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Capture of proxy traffic for offline cache simulation.
+
+A CaptureLog records every proxied request and every invalidation as a
+fixed-size binary record. Identifiers (app ids, user ids, connections and
+query strings) are replaced by 32-bit salted hashes. Field lists are recorded
+as 32-bit masks with one bit per field (chosen by a salted hash), so that
+requested fields can be matched against invalidated ones. The salt is random
+and never written out, so a capture reveals the shape of the traffic but none
+of the ids in it. See fbproxy.replay for the tool that replays a capture
+through the cache.
+
+The log in use is stored in `log`. It is None (no capture) unless the
+launcher configures one.
+"""
+import hashlib
+import os
+import struct
+import threading
+import time
+import urllib
+
+
+log = None
+
+REQUEST = 1
+INVALIDATION = 2  # a path in one app's context
+USER_INVALIDATION = 3  # a path of a user, or all of them, for every app
+FIELD_INVALIDATION = 4  # fields of a user's tables, for every app
+
+CACHEABLE = 1  # flag: the request was handed to the cache
+ALL_PATHS = 2  # flag: the user invalidation is for all of the user's paths
+
+# kind, flags, time, app, viewer, object, connection, query, fields, size
+RECORD = struct.Struct('<BBdIIIIIII')
+
+
+class CaptureLog(object):
+    """ Appends anonymized request and invalidation records to a file.
+
+    Each record is written with a single unbuffered write in append mode, so
+    records are never split, and none are lost if the process exits without
+    closing the log.
+    """
+    def __init__(self, path):
+        self.salt = os.urandom(16)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.lock = threading.Lock()
+
+    def anonymize(self, value):
+        """ Maps an identifier to a salted 32-bit hash. Empty maps to 0."""
+        if not value:
+            return 0
+        return struct.unpack('<I',
+                hashlib.md5(self.salt + value).digest()[:4])[0] or 1
+
+    def field_mask(self, fields):
+        """ Maps a list of fields to a mask with one bit set per field."""
+        mask = 0
+        for field in fields:
+            if field:
+                mask |= 1 << (self.anonymize(field) % 32)
+        return mask
+
+    def record_request(self, acctoken_pieces, uriparts, query, cacheable,
+                       size):
+        """ Records a request, given the parsed pieces of its access token,
+        its (fixed) path parts and its query parameters.
+        """
+        query = dict(query)
+        query.pop('access_token', None)
+        fields = query.pop('fields', [''])[0]
+        self._write(REQUEST, CACHEABLE if cacheable else 0,
+                    self.anonymize(acctoken_pieces[0]),
+                    self.anonymize(acctoken_pieces[2]),
+                    self.anonymize(uriparts[0]),
+                    self.anonymize('/'.join(uriparts[1:])),
+                    self.anonymize(urllib.urlencode(sorted(query.items()),
+                                                    True)),
+                    self.field_mask(fields.split(',')), size)
+
+    def record_invalidation(self, appid, url):
+        """ Records the invalidation of a path in an app's context."""
+        parts = url.strip('/').split('/')
+        self._write(INVALIDATION, 0, self.anonymize(appid), 0,
+                    self.anonymize(parts[0]),
+                    self.anonymize('/'.join(parts[1:])), 0, 0, 0)
+
+    def record_user_invalidation(self, uid, paths=None):
+        """ Records the invalidation of a user's entries for every app.
+
+        Like cache.invalidate_user, paths limits this to the given paths.
+        """
+        if paths is None:
+            self._write(USER_INVALIDATION, ALL_PATHS, 0, 0,
+                        self.anonymize(uid), 0, 0, 0, 0)
+            return
+        for path in paths:
+            parts = path.strip('/').split('/')
+            self._write(USER_INVALIDATION, 0, 0, 0, self.anonymize(parts[0]),
+                        self.anonymize('/'.join(parts[1:])), 0, 0, 0)
+
+    def record_field_invalidation(self, uid, fields):
+        """ Records that fields of a user's tables went stale, for every app.
+        """
+        self._write(FIELD_INVALIDATION, 0, 0, 0, self.anonymize(uid), 0, 0,
+                    self.field_mask(fields), 0)
+
+    def _write(self, kind, flags, app, viewer, obj, conn, query, fields,
+               size):
+        record = RECORD.pack(kind, flags, time.time(), app, viewer, obj,
+                             conn, query, fields, size)
+        self.lock.acquire()
+        try:
+            if self.fd is not None:
+                os.write(self.fd, record)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.lock.release()
+
+
+def read(path):
+    """ Yields the records of a capture file as tuples (see RECORD)."""
+    capture = open(path, 'rb')
+    size = RECORD.size
+    chunk_records = 65536
+    while True:
+        chunk = capture.read(size * chunk_records)
+        for offset in xrange(0, len(chunk) - size + 1, size):
+            yield RECORD.unpack_from(chunk, offset)
+        if len(chunk) < size * chunk_records:
+            break
+    capture.close()
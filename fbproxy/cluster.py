@@ -0,0 +1,284 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Sharding of the cache across a cluster of proxy nodes.
+
+Every node of the cluster knows the full list of nodes, and places them on a
+consistent-hash ring. Each cache key (path + "__" + appid) is owned by exactly
+one node. Requests for keys owned by another node are forwarded to that node's
+internal cluster endpoint, so each object is only cached (and only fetched
+from the Graph API) once across the whole cluster.
+"""
+import bisect
+import hashlib
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+import logging
+from fbproxy import apps, admission
+from fbproxy.requesthandler import ProxyRequestHandler, strip_hop_headers, \
+        rejected_response
+
+
+class HashRing(object):
+    """ A consistent-hash ring of nodes.
+
+    Each node is placed on the ring `vnodes` times, so keys are spread evenly
+    and adding or removing a node only moves a 1/N share of the keys.
+    """
+    def __init__(self, nodes, vnodes=160):
+        self.nodes = list(nodes)
+        self.points = []
+        self.owners = {}
+        for node in self.nodes:
+            for i in xrange(vnodes):
+                point = _hash(node + '#' + str(i))
+                self.owners[point] = node
+                self.points.append(point)
+        self.points.sort()
+
+    def owner(self, key):
+        """ Returns the node owning the given key."""
+        pos = bisect.bisect(self.points, _hash(key))
+        if pos == len(self.points):
+            pos = 0
+        return self.owners[self.points[pos]]
+
+
+def _hash(value):
+    return long(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class PeerConnection(object):
+    """ A small pool of persistent HTTP connections to one cluster node."""
+    def __init__(self, node, timeout=None):
+        (self.host, port) = node.rsplit(':', 1)
+        self.port = int(port)
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None):
+        """ Performs a request, returning (response, body).
+
+        A connection taken from the pool may have been closed by the peer in
+        the meantime, so a failure on a reused connection is retried once on
+        a fresh one.
+        """
+        if not headers:
+            headers = {}
+        self.lock.acquire()
+        conn = self.idle.pop() if self.idle else None
+        self.lock.release()
+        if conn:
+            try:
+                return self._send(conn, method, url, body, headers)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+        conn = httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+        try:
+            return self._send(conn, method, url, body, headers)
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            raise
+
+    def _send(self, conn, method, url, body, headers):
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self.lock.acquire()
+            self.idle.append(conn)
+            self.lock.release()
+        return (response, data)
+
+
+class ClusterCache(object):
+    """ A cache which spreads its keys over the nodes of a cluster.
+
+    Keys owned by this node are handled by the wrapped local cache. All other
+    requests and invalidations are sent to the owning node. If the owner
+    cannot be reached, requests are served from the local cache instead, so a
+    failed node degrades hit rates rather than availability.
+    """
+    def __init__(self, local, nodes, self_node, vnodes=160, timeout=None):
+        self.local = local
+        self.self_node = self_node
+        self.ring = HashRing(nodes, vnodes)
+        self.peers = dict((node, PeerConnection(node, timeout)) for node
+                          in nodes if node != self_node)
+
+    def handle_request(self, query, path, querystring, app, server):
+        """ Handles a request here, or forwards it to the owning node."""
+        appid = '0'
+        if 'access_token' in query:
+            token = ProxyRequestHandler.parse_access_token(
+                    query['access_token'][0])
+            if token:
+                appid = token[0]
+        owner = self.ring.owner(path + "__" + appid)
+        if owner == self.self_node:
+            return self.local.handle_request(query, path, querystring, app,
+                                             server)
+        try:
+            (response, body) = self.peers[owner].request('GET',
+                    '/fetch/' + urllib.quote(path) + '?' + querystring,
+                    headers={'X-Fbproxy-App': app.id})
+        except (socket.error, httplib.HTTPException):
+            logging.warning('cluster node ' + owner + ' is unreachable. ' +
+                            'serving ' + path + ' locally')
+            return self.local.handle_request(query, path, querystring, app,
+                                             server)
+        statusline = str(response.status) + " " + response.reason
+        return (statusline, strip_hop_headers(response.getheaders()), body)
+
+    def invalidate(self, appid, url):
+        """ Sends the invalidation to the nodes owning the affected keys."""
+        owners = set([self.ring.owner(url + "__" + appid),
+                      self.ring.owner(url + "__0")])
+        for owner in owners:
+            if owner == self.self_node:
+                self.local.invalidate(appid, url)
+                continue
+            try:
+                self.peers[owner].request('POST', '/invalidate',
+                        urllib.urlencode({'appid': appid, 'url': url}),
+                        {'Content-type': 'application/x-www-form-urlencoded'})
+            except (socket.error, httplib.HTTPException):
+                logging.error('failed to send invalidation of ' + url +
+                              ' to cluster node ' + owner)
+
+    def invalidate_user(self, uid, paths=None):
+        """ Sends the invalidation to every node.
+
+        A user's entries are spread over the whole ring, so this cannot be
+        sent to their owners only.
+        """
+        params = [('uid', uid)] + [('path', x) for x in paths or ()]
+        for (node, peer) in self.peers.iteritems():
+            try:
+                peer.request('POST', '/invalidate', urllib.urlencode(params),
+                        {'Content-type': 'application/x-www-form-urlencoded'})
+            except (socket.error, httplib.HTTPException):
+                logging.error('failed to send invalidation of user ' + uid +
+                              ' to cluster node ' + node)
+        return self.local.invalidate_user(uid, paths)
+
+    def invalidate_fields(self, uid, fields):
+        """ Sends the field invalidation to every node, like invalidate_user.
+        """
+        params = [('uid', uid)] + [('field', x) for x in fields]
+        for (node, peer) in self.peers.iteritems():
+            try:
+                peer.request('POST', '/invalidate', urllib.urlencode(params),
+                        {'Content-type': 'application/x-www-form-urlencoded'})
+            except (socket.error, httplib.HTTPException):
+                logging.error('failed to send invalidation of user ' + uid +
+                              ' fields to cluster node ' + node)
+        return self.local.invalidate_fields(uid, fields)
+
+    def invalidate_where(self, predicate):
+        # every node reloads its own configuration, so this stays local
+        return self.local.invalidate_where(predicate)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return self.local.stats()
+
+
+class ClusterRequestHandler(object):
+    """ WSGI application for the internal cluster endpoint.
+
+    This serves two kinds of requests from other nodes: GET /fetch/<path>,
+    which looks up a forwarded request in this node's local cache, and POST
+    /invalidate, which invalidates a key owned by this node (or, given a uid,
+    all of a user's entries on this node, or given fields as well, those fields
+    of the user's tables). Like the proxy
+    endpoint, this endpoint must only be reachable by the cluster itself.
+    """
+    def __init__(self, environ, start_response, cache, appdict, server):
+        self.start = start_response
+        self.env = environ
+        self.cache = cache
+        self.apps = appdict
+        self.server = server
+
+    def __iter__(self):
+        path = self.env['PATH_INFO']
+        if self.env['REQUEST_METHOD'] == 'GET' and path.startswith('/fetch/'):
+            return self.handle_fetch(path[len('/fetch/'):])
+        elif self.env['REQUEST_METHOD'] == 'POST' and path == '/invalidate':
+            return self.handle_invalidate()
+        return self.not_found()
+
+    def not_found(self):
+        self.start('404 Not Found', [('Content-type', 'text/plain')])
+        yield "Unknown cluster request"
+
+    def handle_fetch(self, path):
+        """ Serve a forwarded request from the local cache."""
+        app = apps.get_app(self.env.get('HTTP_X_FBPROXY_APP'), self.apps)
+        if not app:
+            return self.not_found()
+        querystring = self.env['QUERY_STRING']
+        try:
+            response = self.cache.handle_request(
+                    urlparse.parse_qs(querystring), path, querystring, app,
+                    self.server)
+        except admission.UpstreamRejected:
+            response = rejected_response()
+        return self.respond(response)
+
+    def handle_invalidate(self):
+        """ Apply an invalidation forwarded by another node."""
+        length = int(self.env.get('CONTENT_LENGTH') or 0)
+        params = urlparse.parse_qs(self.env['wsgi.input'].read(length))
+        if 'uid' in params and 'field' in params:
+            self.cache.invalidate_fields(params['uid'][0], params['field'])
+        elif 'uid' in params:
+            self.cache.invalidate_user(params['uid'][0], params.get('path'))
+        elif 'appid' in params and 'url' in params:
+            self.cache.invalidate(params['appid'][0], params['url'][0])
+        else:
+            self.start('400 Bad Request', [('Content-type', 'text/plain')])
+            return iter(["Missing appid or url"])
+        return self.respond(('200 OK', [('Content-type', 'text/plain')],
+                             'Invalidated'))
+
+    def respond(self, response):
+        self.start(response[0], strip_hop_headers(response[1]))
+        yield response[2]
+
+
+class ClusterRequestHandlerFactory(object):
+    """ Creates ClusterRequestHandlers for the given local cache."""
+    def __init__(self, cache, appdict, server):
+        self.cache = cache
+        self.appdict = appdict
+        self.server = server
+
+    def set_apps(self, appdict):
+        self.appdict = appdict
+
+    def __call__(self, environ, start_response):
+        return ClusterRequestHandler(environ, start_response, self.cache,
+                self.appdict, self.server)
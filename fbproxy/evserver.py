@@ -0,0 +1,67 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Event-loop server engine, as an alternative to the threaded CherryPy one.
+
+With the CherryPy engine, every request in flight holds a worker thread for
+the whole upstream round trip. This engine runs the same WSGI applications
+(ProxyRequestHandler and RealtimeUpdateHandler, over the same cache and App
+objects) on gevent instead: each request is a greenlet of a few KB, and
+upstream HTTPS calls made through httplib yield to the event loop while they
+wait. Tens of thousands of concurrent cache misses then cost a few MB rather
+than tens of thousands of threads.
+
+gevent is optional, and only needed when server_engine = 'gevent'.
+"""
+import socket
+
+
+def patch():
+    """ Makes socket, ssl and threading cooperative.
+
+    This must be called before any of the proxy's locks, sockets or threads
+    are created.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise ImportError("server_engine = 'gevent' requires gevent. " +
+                          "Install it with: sudo easy_install gevent")
+    monkey.patch_all()
+
+
+class EventLoopServer(object):
+    """ A gevent WSGI server with the interface of CherryPyWSGIServer.
+
+    start() blocks until the server is stopped, just like CherryPy's. If
+    max_connections is set, at most that many requests are served at once.
+    """
+    def __init__(self, bind_addr, wsgi_app, max_connections=None):
+        from gevent.pywsgi import WSGIServer
+        from gevent.pool import Pool
+        spawn = Pool(max_connections) if max_connections else 'default'
+        self.server = WSGIServer(bind_addr, wsgi_app, spawn=spawn, log=None)
+
+    @classmethod
+    def from_socket(cls, sock, wsgi_app, max_connections=None):
+        """ Creates a server for a bound socket, such as a Unix socket."""
+        sock.listen(socket.SOMAXCONN)
+        return cls(sock, wsgi_app, max_connections)
+
+    def start(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.stop()
@@ -20,6 +20,9 @@ once, to save space.
 """
 
 import hashlib
+import threading
+import time
+from fbproxy.slab import SlabHandle
 
 
 class HashedDictionary(object):
@@ -31,18 +34,56 @@ class HashedDictionary(object):
     we access the actual response in a second dictionary. Note that parts
     of requests are significant, while others are not. Consumers are expected
     to partition their data into nonhashed and hashed data for insertion and
-    retrieval.
+    retrieval. Responses no longer referenced by any key are dropped. nbytes
+    is a running estimate of the memory held by the dictionary, which the
+    cache uses for byte quotas, and created the time at which it was made.
+
+    For stored tables (field -> value dicts), staleness is tracked per field:
+    mark_stale records the mark (a running count of calls to it) at which
+    each field last changed, and refreshed the mark at which each key's
+    fields were last fetched. A field of a key is stale if it changed after
+    it was fetched.
+
+    If a SlabArena is given, stored tuples whose last item is a response body
+    (rather than a parsed table or list) keep that body in the arena, and the
+    bodies rendered from stored tables can be kept there too (see
+    keep_rendered).
+    Parsed data stays on the Python heap, so that reads never decode. Bodies
+    are read as buffers over the arena. release() must be called once the
+    dictionary is dropped, to free its arena space.
     """
-    def __init__(self):
+    def __init__(self, arena=None):
         self.content = {}
         self.keymap = {}
+        self.refs = {}  # hash -> number of keys mapped to it
+        self.sizes = {}  # hash -> bytes counted for it in nbytes
+        self.nbytes = 0
+        self.created = time.time()
+        self.marks = 0
+        self.changed = {}  # field -> mark at which it last changed
+        self.fetched = {}  # key -> (mark, {field: mark}) of its fields
+        self.rendered = {}  # hash -> {fields: SlabHandle of a rendered body}
+        self.arena = arena
+        self.released = False
+        self.lock = threading.Lock()
 
     def __getitem__(self, key):
         """ Fetch the tuple for the given key."""
-        if key in self.keymap:
-            valhash = self.keymap[key]
-            return self.content[valhash]
-        return None
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """ Fetch (tuple, hash) for the given key, or (None, '')."""
+        self.lock.acquire()
+        try:
+            if key in self.keymap:
+                valhash = self.keymap[key]
+                data = self.content[valhash]
+                if data and isinstance(data[-1], SlabHandle):
+                    data = data[:-1] + (self.arena.view(data[-1]),)
+                return (data, valhash)
+            return (None, '')
+        finally:
+            self.lock.release()
 
     def __setitem__(self, key, data):
         """ Store the given response in the dictionary with the given key.
@@ -52,14 +93,192 @@ class HashedDictionary(object):
         point key at the existing entry with that hash.
         """
         (stored_data, valhashed) = data
+        self.store(key, valhashed, lambda: stored_data)
+
+    def store(self, key, valhashed, make_data):
+        """ Store a response, building its stored data only if needed.
+
+        Like __setitem__, except that make_data is only called (to produce
+        the data to store) if no response with the same hash is stored yet.
+        This saves both hashing twice and, for instance, parsing a body we
+        already have the parsed form of.
+        """
         valhash = hashlib.sha1(valhashed).digest()
-        self.keymap[key] = valhash
-        if not valhash in self.content:
-            self.content[valhash] = stored_data
+        self.lock.acquire()
+        try:
+            old = self.keymap.get(key)
+            if old == valhash:
+                return
+            if old is None:
+                self.nbytes += len(key) + len(valhash)
+            if not valhash in self.content:
+                self.content[valhash] = self._put(make_data())
+                self.sizes[valhash] = len(valhashed)
+                self.nbytes += len(valhashed)
+            self.refs[valhash] = self.refs.get(valhash, 0) + 1
+            self.keymap[key] = valhash
+            if old is not None:
+                self._unref(old)
+        finally:
+            self.lock.release()
+
+    def _unref(self, valhash):
+        """ Drops a reference to valhash, and its data with the last one.
+
+        The caller must hold self.lock.
+        """
+        self.refs[valhash] -= 1
+        if self.refs[valhash]:
+            return
+        del self.refs[valhash]
+        data = self.content.pop(valhash)
+        self.nbytes -= self.sizes.pop(valhash)
+        if data and isinstance(data[-1], SlabHandle):
+            self.arena.release(data[-1])
+        for handle in self.rendered.pop(valhash, {}).itervalues():
+            self.arena.release(handle)
 
     def __contains__(self, key):
         return key in self.keymap
 
+    def hash_of(self, key):
+        """ The hash of the data stored for key ('' if there is none)."""
+        return self.keymap.get(key, '')
+
+    def mark_stale(self, fields):
+        """ Marks the given fields of every stored table stale."""
+        self.marks += 1
+        for field in fields:
+            self.changed[field] = self.marks
+
+    def stale_fields(self, key):
+        """ Returns the set of fields of key's table which are stale."""
+        (mark, fields) = self.fetched.get(key, (0, None))
+        if mark == self.marks:
+            return set()
+        # items() copies, so a concurrent mark_stale cannot break this
+        return set(x for (x, changed) in self.changed.items()
+                   if changed > (fields.get(x, mark) if fields else mark))
+
+    def refreshed(self, key, fields, marks, partial=False):
+        """ Records that fields of the table for key were just fetched.
+
+        marks is the value of self.marks from before the fetch, so fields
+        marked stale while it was running stay stale. Unless partial is set,
+        fields are all the fields of the table.
+        """
+        if not partial:
+            self.fetched[key] = (marks, None)
+            return
+        (mark, fetched) = self.fetched.get(key, (0, None))
+        fetched = dict(fetched or ())
+        for field in fields:
+            fetched[field] = marks
+        self.fetched[key] = (mark, fetched)
+        if not self.stale_fields(key):
+            self.fetched[key] = (marks, None)
+
+    def rendered_body(self, valhash, fields):
+        """ Returns the body kept for the table with the given hash rendered
+        with the given fields, or None.
+        """
+        self.lock.acquire()
+        try:
+            handle = self.rendered.get(valhash, {}).get(fields)
+            return self.arena.view(handle) if handle else None
+        finally:
+            self.lock.release()
+
+    def keep_rendered(self, valhash, fields, body):
+        """ Keeps a body rendered from the table with the given hash in the
+        arena, if there is room, for rendered_body to return.
+        """
+        if not self.arena:
+            return
+        self.lock.acquire()
+        try:
+            if self.released or valhash not in self.content or \
+                    fields in self.rendered.get(valhash, {}):
+                return
+            handle = self.arena.put(body)
+            if handle:
+                self.rendered.setdefault(valhash, {})[fields] = handle
+        finally:
+            self.lock.release()
+
+    def _put(self, data):
+        """ Moves a body ending data into the arena, if there is room."""
+        if self.arena and not self.released and data and \
+                isinstance(data[-1], str):
+            handle = self.arena.put(data[-1])
+            if handle:
+                return data[:-1] + (handle,)
+        return data
+
     def contains_hash(self, valhashdata):
         """ Determines if the data has a matching hash already in the dict."""
         return hashlib.sha1(valhashdata).digest() in self.content
+
+    def release(self):
+        """ Free the arena space held by this dictionary.
+
+        The keys of bodies held in the arena are dropped, so they are never
+        read again. Bodies stored after this point are kept on the Python
+        heap.
+        """
+        self.lock.acquire()
+        try:
+            if self.released or not self.arena:
+                return
+            self.released = True
+            for (key, valhash) in self.keymap.items():
+                data = self.content[valhash]
+                if data and isinstance(data[-1], SlabHandle):
+                    del self.keymap[key]
+                    self.nbytes -= len(key) + len(valhash)
+                    self._unref(valhash)
+            for handles in self.rendered.itervalues():
+                for handle in handles.itervalues():
+                    self.arena.release(handle)
+            self.rendered.clear()
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        """ Returns the contents as (created, keymap, content, sizes).
+
+        The result only holds plain data, so it can be marshalled. Bodies in
+        the arena are copied out. Tables with stale fields are left out, to
+        be fetched afresh. Returns None if the dictionary has been released.
+        """
+        self.lock.acquire()
+        try:
+            if self.released:
+                return None
+            keymap = [x for x in self.keymap.items()
+                      if not self.stale_fields(x[0])]
+            content = {}
+            for (_, valhash) in keymap:
+                data = self.content[valhash]
+                if data and isinstance(data[-1], SlabHandle):
+                    data = data[:-1] + (str(self.arena.view(data[-1])),)
+                content[valhash] = data
+            sizes = dict((x, self.sizes[x]) for x in content)
+            return (self.created, keymap, content, sizes)
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def load(cls, dumped, arena=None):
+        """ Rebuilds a dictionary from the result of dump()."""
+        hashdict = cls(arena)
+        (hashdict.created, keymap, content, sizes) = dumped
+        for (key, valhash) in keymap:
+            if not valhash in hashdict.content:
+                hashdict.content[valhash] = hashdict._put(content[valhash])
+                hashdict.sizes[valhash] = sizes[valhash]
+                hashdict.nbytes += sizes[valhash]
+            hashdict.refs[valhash] = hashdict.refs.get(valhash, 0) + 1
+            hashdict.keymap[key] = valhash
+            hashdict.nbytes += len(key) + len(valhash)
+        return hashdict
@@ -0,0 +1,234 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Hedging of slow cache fills.
+
+A few slow Graph API responses set the tail latency of the proxy. Cache fills
+are idempotent GETs, so when one has not been answered within a delay, the
+Hedger sends the same request again on another connection. Whichever response
+arrives first is used, and the other request is cancelled by shutting down
+its connection.
+
+The delay is a percentile of recent fill latencies, so that only the slowest
+fills are hedged. Hedges are also paid for from a token bucket which gains
+`budget` tokens per fill, so at most that fraction of fills is ever hedged.
+With admission control, a hedge is only sent if an upstream slot is free
+right away; hedges never queue.
+
+The hedger in use is stored in `hedger`. It is None (no hedging) unless the
+launcher configures one.
+"""
+import collections
+import httplib
+import socket
+import sys
+import threading
+import time
+from fbproxy import admission
+
+
+hedger = None
+
+
+class Attempt(object):
+    """ One upstream GET, which another thread may cancel."""
+    def __init__(self, path, querystring, server):
+        self.url = path + "?" + querystring
+        self.conn = httplib.HTTPSConnection(server)
+
+    def run(self):
+        """ Returns the response as (status, headers, body, status num)."""
+        try:
+            self.conn.request('GET', self.url)
+            response = self.conn.getresponse()
+            statusline = str(response.status) + " " + response.reason
+            headers = response.getheaders()
+            body = response.read()
+            response.close()
+            return (statusline, headers, body, response.status)
+        finally:
+            self.conn.close()
+
+    def cancel(self):
+        """ Makes run() fail, if it is waiting on the network."""
+        sock = self.conn.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # closed already
+
+
+class Race(object):
+    """ The attempts at one fill. The first one to finish wins."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.winner = None
+        self.outcome = None
+        self.hedge = None
+
+    def start_hedge(self, attempt):
+        """ Returns whether attempt may still be sent as a hedge."""
+        self.lock.acquire()
+        ok = self.winner is None
+        if ok:
+            self.hedge = attempt
+        self.lock.release()
+        return ok
+
+    def finish(self, attempt, outcome):
+        """ Returns whether attempt won, recording its outcome if so.
+
+        outcome is (result, exc_info), one of which is None.
+        """
+        self.lock.acquire()
+        first = self.winner is None
+        if first:
+            self.winner = attempt
+            self.outcome = outcome
+        self.lock.release()
+        if first:
+            self.done.set()
+        return first
+
+
+class Hedger(object):
+    """ Sends a second request for cache fills slower than the percentile of
+    recent ones.
+
+    The delay is computed from the last `window` fill latencies, once there
+    are min_samples of them, and is at least min_delay seconds. The token
+    bucket for hedges holds at most `burst` tokens.
+    """
+    def __init__(self, percentile=95, budget=0.05, min_delay=0.01,
+                 window=1000, min_samples=100, burst=10):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.burst = burst
+        self.samples = collections.deque(maxlen=window)
+        self.fresh = 0  # samples since the delay was computed
+        self.delay = None
+        self.tokens = float(burst)
+        self.fills = 0
+        self.hedges = 0
+        self.wins = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, path, querystring, server, app_id=None):
+        """ GETs the requested object as (status, headers, body, status num)
+
+        The primary request is made on the calling thread, and a hedge, if
+        needed, on a thread of its own. Errors are raised as if the primary
+        request had been made alone, unless the hedge succeeds first.
+        """
+        self.lock.acquire()
+        self.fills += 1
+        self.tokens = min(self.burst, self.tokens + self.budget)
+        delay = self.delay
+        self.lock.release()
+
+        race = Race()
+        primary = Attempt(path, querystring, server)
+        if delay is not None:
+            thread = threading.Thread(target=self._hedge_after,
+                    args=(delay, race, primary, path, querystring, server,
+                          app_id))
+            thread.daemon = True
+            thread.start()
+        started = time.time()
+        try:
+            outcome = (primary.run(), None)
+        except Exception:
+            outcome = (None, sys.exc_info())
+        if race.finish(primary, outcome):
+            if race.hedge:
+                race.hedge.cancel()
+        else:
+            race.done.wait()
+        # when the hedge won, this only bounds the primary's latency
+        self._record(time.time() - started)
+        (result, error) = race.outcome
+        if error:
+            raise error[0], error[1], error[2]
+        return result
+
+    def _hedge_after(self, delay, race, primary, path, querystring, server,
+                     app_id):
+        """ Sends a hedge for primary if it is still running after delay."""
+        time.sleep(delay)
+        if race.winner or not self._take_token():
+            return
+        limiter = admission.controller
+        if limiter:
+            started = limiter.try_acquire(app_id)
+            if started is None:
+                return
+        hedge = Attempt(path, querystring, server)
+        status = None
+        body = ''
+        won = False
+        try:
+            if not race.start_hedge(hedge):
+                return
+            self.lock.acquire()
+            self.hedges += 1
+            self.lock.release()
+            try:
+                result = hedge.run()
+            except Exception:
+                return  # the primary's outcome stands
+            (status, body) = (result[3], result[2])
+            won = race.finish(hedge, (result, None))
+            if won:
+                self.lock.acquire()
+                self.wins += 1
+                self.lock.release()
+                primary.cancel()
+        finally:
+            if limiter:
+                limiter.release(app_id, started, status, body,
+                                cancelled=not won)
+
+    def _take_token(self):
+        self.lock.acquire()
+        ok = self.tokens >= 1
+        if ok:
+            self.tokens -= 1
+        self.lock.release()
+        return ok
+
+    def _record(self, latency):
+        self.lock.acquire()
+        self.samples.append(latency)
+        self.fresh += 1
+        if len(self.samples) >= self.min_samples and (self.delay is None or
+                self.fresh * 10 >= self.samples.maxlen):
+            ordered = sorted(self.samples)
+            index = min(len(ordered) - 1,
+                        int(len(ordered) * self.percentile / 100.0))
+            self.delay = max(self.min_delay, ordered[index])
+            self.fresh = 0
+        self.lock.release()
+
+    def stats(self):
+        """ Returns the current delay and how many fills were hedged."""
+        self.lock.acquire()
+        ret = {'delay': self.delay, 'fills': self.fills,
+               'hedges': self.hedges, 'wins': self.wins}
+        self.lock.release()
+        return ret
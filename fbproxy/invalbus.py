@@ -0,0 +1,263 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Broadcasting of invalidations between replicated proxy instances.
+
+Facebook delivers each realtime update to only one of the replicas behind a
+load balancer. BroadcastCache wraps a replica's cache so that every
+invalidation it performs is also published on an InvalidationBus, which
+applies it on every other replica.
+
+Invalidations are sent in batches. Each batch carries the sender's sequence
+number, and idle senders send heartbeats with their latest sequence number.
+A replica which notices a gap in a sender's sequence has lost invalidations,
+so it flushes its whole cache rather than risk serving stale data.
+"""
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import logging
+
+
+class InvalidationBus(object):
+    """ Base class for invalidation transports.
+
+    Subclasses implement send(packet) and receive(), which blocks until a
+    packet arrives and returns it. Everything else (batching, sequencing and
+    gap detection) is handled here.
+    """
+    def __init__(self, batch_size=100, batch_interval=0.05, heartbeat=1.0):
+        self.node = '%s:%d:%d' % (socket.gethostname(), os.getpid(),
+                                  random.randint(0, 1000000000))
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.heartbeat = heartbeat
+        self.seq = 0
+        self.pending = []
+        self.cond = threading.Condition()
+        self.last_seq = {}
+        self.cache = None
+
+    def start(self, cache):
+        """ Start sending, and apply received invalidations to cache."""
+        self.cache = cache
+        for target in (self._send_loop, self._receive_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, item):
+        """ Queue an invalidation (a list starting with its kind) to send."""
+        self.cond.acquire()
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size:
+            self.cond.notify()
+        self.cond.release()
+
+    def _send_loop(self):
+        last_sent = 0
+        while True:
+            self.cond.acquire()
+            if len(self.pending) < self.batch_size:
+                self.cond.wait(self.batch_interval)
+            items = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            if items:
+                self.seq += 1
+            seq = self.seq
+            self.cond.release()
+            if not items and time.time() - last_sent < self.heartbeat:
+                continue
+            try:
+                self.send(json.dumps({'node': self.node, 'seq': seq,
+                                      'items': items}))
+            except socket.error, err:
+                # peers will see the gap in the sequence and flush
+                logging.error('failed to send invalidations: ' + str(err))
+            last_sent = time.time()
+
+    def _receive_loop(self):
+        while True:
+            try:
+                packet = json.loads(self.receive())
+                self.apply(packet['node'], packet['seq'], packet['items'])
+            except (ValueError, KeyError, TypeError):
+                logging.warning('dropping malformed invalidation packet')
+            except socket.error, err:
+                logging.error('error receiving invalidations: ' + str(err))
+                time.sleep(self.heartbeat)
+
+    def apply(self, node, seq, items):
+        """ Apply a batch received from node, flushing the cache on a gap."""
+        if node == self.node:
+            return  # our own multicast, looped back
+        if node in self.last_seq:
+            expected = self.last_seq[node] + (1 if items else 0)
+            if seq != expected:
+                logging.warning('lost invalidations from ' + node +
+                                ' (expected ' + str(expected) + ', got ' +
+                                str(seq) + '). flushing the cache')
+                self.cache.clear()
+        self.last_seq[node] = max(seq, self.last_seq.get(node, 0))
+        for item in items:
+            if item[0] == 'url':
+                self.cache.invalidate(item[1], item[2])
+            elif item[0] == 'user':
+                self.cache.invalidate_user(item[1], item[2])
+            elif item[0] == 'fields':
+                self.cache.invalidate_fields(item[1], item[2])
+
+    def send(self, packet):
+        raise NotImplementedError
+
+    def receive(self):
+        raise NotImplementedError
+
+
+class MulticastBus(InvalidationBus):
+    """ Sends invalidation batches as UDP multicast datagrams."""
+    def __init__(self, group, port, ttl=1, **kwargs):
+        InvalidationBus.__init__(self, **kwargs)
+        self.group = group
+        self.port = port
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        membership = struct.pack('4sl', socket.inet_aton(group),
+                                 socket.INADDR_ANY)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             membership)
+
+    def send(self, packet):
+        self.out.sendto(packet, (self.group, self.port))
+
+    def receive(self):
+        return self.sock.recv(65536)
+
+
+class TcpMeshBus(InvalidationBus):
+    """ Sends invalidation batches to every peer over persistent TCP streams.
+
+    Each packet is framed with a 4-byte length. Connections to peers that go
+    away are re-established on the next send; anything lost in the meantime
+    shows up as a sequence gap on the peer.
+    """
+    def __init__(self, listen, peers, **kwargs):
+        InvalidationBus.__init__(self, **kwargs)
+        self.peers = dict((peer, None) for peer in peers)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(listen)
+        self.listener.listen(len(self.peers) + 1)
+        self.inbox = []
+        self.inbox_cond = threading.Condition()
+        accept_thread = threading.Thread(target=self._accept_loop)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def send(self, packet):
+        frame = struct.pack('!I', len(packet)) + packet
+        failed = None
+        for peer in self.peers:
+            try:
+                if not self.peers[peer]:
+                    (host, port) = peer.rsplit(':', 1)
+                    self.peers[peer] = socket.create_connection(
+                            (host, int(port)), self.heartbeat)
+                self.peers[peer].sendall(frame)
+            except socket.error, err:
+                if self.peers[peer]:
+                    self.peers[peer].close()
+                self.peers[peer] = None
+                failed = err
+        if failed:
+            raise failed
+
+    def receive(self):
+        self.inbox_cond.acquire()
+        while not self.inbox:
+            self.inbox_cond.wait()
+        packet = self.inbox.pop(0)
+        self.inbox_cond.release()
+        return packet
+
+    def _accept_loop(self):
+        while True:
+            (conn, _) = self.listener.accept()
+            reader = threading.Thread(target=self._read_loop, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def _read_loop(self, conn):
+        stream = conn.makefile('rb')
+        try:
+            while True:
+                header = stream.read(4)
+                if len(header) < 4:
+                    break
+                packet = stream.read(struct.unpack('!I', header)[0])
+                self.inbox_cond.acquire()
+                self.inbox.append(packet)
+                self.inbox_cond.notify()
+                self.inbox_cond.release()
+        except socket.error:
+            pass
+        conn.close()
+
+
+class BroadcastCache(object):
+    """ A cache whose invalidations are also published on a bus.
+
+    Invalidations received from the bus are applied to the wrapped cache
+    directly, so they are never published again.
+    """
+    def __init__(self, cache, bus):
+        self.cache = cache
+        self.bus = bus
+        bus.start(cache)
+
+    def handle_request(self, query, path, querystring, app, server):
+        return self.cache.handle_request(query, path, querystring, app,
+                                         server)
+
+    def invalidate(self, appid, url):
+        self.cache.invalidate(appid, url)
+        self.bus.publish(['url', appid, url])
+
+    def invalidate_user(self, uid, paths=None):
+        removed = self.cache.invalidate_user(uid, paths)
+        self.bus.publish(['user', uid, list(paths) if paths else None])
+        return removed
+
+    def invalidate_fields(self, uid, fields):
+        marked = self.cache.invalidate_fields(uid, fields)
+        self.bus.publish(['fields', uid, list(fields)])
+        return marked
+
+    def invalidate_where(self, predicate):
+        # every replica reloads its own configuration, so this stays local
+        return self.cache.invalidate_where(predicate)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
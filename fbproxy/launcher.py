@@ -22,13 +22,28 @@ proxy endpoint should be accessible only from a small set of machines
 (ideally the web servers that would otherwise be making direct Facebook Graph
 API calls).
 """
+import errno
+import multiprocessing
+import os
+import signal
+import socket
 import threading
 import time
+import logging
 from cherrypy import wsgiserver
-from fbproxy import config, apps
+from fbproxy import config, apps, evserver, admission, rturegister, \
+        capture, hedge
 from fbproxy.requesthandler import ProxyRequestHandlerFactory
-from fbproxy.cache import ProxyLruCache
+from fbproxy.cache import ProxyLruCache, LIST_LIMIT
 from fbproxy.rtendpoint import RealtimeUpdateHandlerFactory
+from fbproxy.cluster import ClusterCache, ClusterRequestHandlerFactory
+from fbproxy.invalbus import BroadcastCache, MulticastBus, TcpMeshBus
+from fbproxy.shmcache import SharedMemoryCache
+from fbproxy.listeners import ReusePortWSGIServer, UnixSocketWSGIServer, \
+        remove_stale_socket, unix_socket
+from fbproxy.slab import SlabArena
+from fbproxy.reloader import ConfigReloader
+from fbproxy.snapshot import Snapshotter, warm
 
 
 GRAPH_SERVER = "graph.facebook.com"
@@ -37,30 +52,334 @@ GRAPH_SERVER = "graph.facebook.com"
 def launch(config_file):
     """ Launch the Graph Proxy with the specified config_file."""
     config.load(config_file)
-    cache = ProxyLruCache(config.cache_entries)
+    engine = getattr(config, 'server_engine', 'cherrypy')
+    if engine == 'gevent':
+        if getattr(config, 'workers', 1) > 1:
+            raise ValueError('workers cannot be combined with gevent')
+        evserver.patch()
+    elif engine != 'cherrypy':
+        raise ValueError('unknown server_engine ' + repr(engine))
+    if getattr(config, 'proxy_socket', None) and \
+            getattr(config, 'workers', 1) > 1:
+        raise ValueError('proxy_socket cannot be combined with workers')
+    if getattr(config, 'snapshot_file', None) and \
+            getattr(config, 'workers', 1) > 1:
+        raise ValueError('snapshot_file cannot be combined with workers')
+    if getattr(config, 'capture_file', None) and \
+            getattr(config, 'workers', 1) > 1:
+        raise ValueError('capture_file cannot be combined with workers')
+    if getattr(config, 'proxy_port', None) is None and \
+            not getattr(config, 'proxy_socket', None):
+        raise ValueError('one of proxy_port and proxy_socket must be set')
     appdict = apps.init(config.apps)
+    if getattr(config, 'upstream_limit', None):
+        admission.controller = admission.AdmissionController(
+                config.upstream_limit,
+                getattr(config, 'upstream_app_limit', None),
+                getattr(config, 'upstream_min_limit', 1),
+                getattr(config, 'upstream_latency_target', 1.0),
+                getattr(config, 'upstream_queue_timeout', 1.0),
+                getattr(config, 'upstream_backoff', 0.5),
+                getattr(config, 'upstream_reject_status',
+                        '503 Service Unavailable'))
+    if getattr(config, 'hedge_percentile', None):
+        hedge.hedger = hedge.Hedger(config.hedge_percentile,
+                                    getattr(config, 'hedge_budget', 0.05),
+                                    getattr(config, 'hedge_min_delay', 0.01))
+    if getattr(config, 'capture_file', None):
+        capture.log = capture.CaptureLog(config.capture_file)
+    background_servers = []
+    factories = []
+    workers = []
+    subscriptions = rturegister.Subscriptions()
+    registered = None
+
+    if getattr(config, 'workers', 1) > 1:
+        # the workers must be forked before this process starts any threads
+        cache = SharedMemoryCache(getattr(config, 'shm_slots', 262144),
+                getattr(config, 'shm_arena_bytes', 256 * 1024 * 1024))
+        registered = multiprocessing.Event()
+        workers = [fork_worker(config_file, cache, appdict,
+                               rturegister.StartupGate(registered))
+                   for _ in xrange(config.workers)]
+    else:
+        arena = None
+        if getattr(config, 'body_arena_bytes', None):
+            arena = SlabArena(config.body_arena_bytes,
+                              getattr(config, 'body_arena_file', None))
+        cache = ProxyLruCache(config.cache_entries,
+                              getattr(config, 'cache_bytes', None),
+                              cache_quotas(config.apps),
+                              getattr(config, 'cache_policy', 'lru'), arena,
+                              getattr(config, 'connection_fetch_limit',
+                                      LIST_LIMIT))
+        local_cache = cache
+
+    cluster_nodes = getattr(config, 'cluster_nodes', None)
+    if cluster_nodes and workers:
+        raise ValueError('cluster_nodes cannot be combined with workers')
+    if cluster_nodes:
+        # other nodes talk to the local cache directly, so that forwarded
+        # requests are never forwarded again
+        cluster_handler_factory = ClusterRequestHandlerFactory(cache,
+                appdict, GRAPH_SERVER)
+        factories.append(cluster_handler_factory)
+        cache = ClusterCache(cache, cluster_nodes, config.cluster_self,
+                             getattr(config, 'cluster_vnodes', 160),
+                             getattr(config, 'cluster_timeout', 5))
+        cluster_port = int(config.cluster_self.rsplit(':', 1)[1])
+        background_servers.append(make_server(
+                (getattr(config, 'cluster_interface', '0.0.0.0'),
+                 cluster_port), cluster_handler_factory))
+
+    bus = make_bus()
+    if bus:
+        cache = BroadcastCache(cache, bus)
 
     request_handler_factory = ProxyRequestHandlerFactory(None,
-            cache, appdict, GRAPH_SERVER)
+            cache, appdict, GRAPH_SERVER, subscriptions)
     realtime_handler_factory = RealtimeUpdateHandlerFactory(cache, None,
-                                                            appdict)
+            appdict, subscriptions,
+            getattr(config, 'registration_concurrency', 8),
+            getattr(config, 'registration_retries', 3))
+    factories.extend([request_handler_factory, realtime_handler_factory])
+    snapshot_file = getattr(config, 'snapshot_file', None)
+    snapshotter = None
+    if snapshot_file:
+        snapshotter = Snapshotter(snapshot_file, local_cache, appdict)
+        factories.append(snapshotter)
     endpoint = "http://" + config.public_hostname + ":" + str(
             config.realtime_port) + "/"
+    reloader = ConfigReloader(config_file, cache, appdict, factories,
+            realtime_handler_factory, endpoint, GRAPH_SERVER)
+    watch_config(reloader, workers)
+
+    proxyservers = make_proxy_servers(request_handler_factory)
+    proxyserver = proxyservers.pop(0)
+    background_servers.extend(proxyservers)
+    rtuserver = make_server((config.realtime_interface,
+                             config.realtime_port), realtime_handler_factory)
+    background_servers.append(rtuserver)
+
+    for server in background_servers:
+        server_thread = threading.Thread(target=server.start)
+        server_thread.daemon = True
+        server_thread.start()
 
-    proxyserver = wsgiserver.CherryPyWSGIServer((config.proxy_interface,
-        config.proxy_port), request_handler_factory)
-    rtuserver = wsgiserver.CherryPyWSGIServer((config.realtime_interface,
-        config.realtime_port), realtime_handler_factory)
+    # registration proceeds while the proxy port is already serving; apps
+    # are passed through until their subscription is in place
+    registration_thread = threading.Thread(target=register_when_ready,
+            args=(realtime_handler_factory, endpoint, registered))
+    registration_thread.daemon = True
+    registration_thread.start()
 
-    realtime_port_thread = threading.Thread(target=rtuserver.start)
-    realtime_port_thread.daemon = True
-    realtime_port_thread.start()
-    time.sleep(2)  # give the server time to come up
+    if snapshotter:
+        # the cache serves requests while it is being warmed up
+        warm_thread = threading.Thread(target=warm, args=(local_cache,
+                snapshot_file, appdict, getattr(config, 'snapshot_max_age',
+                                                600)))
+        warm_thread.daemon = True
+        warm_thread.start()
+        snapshot_interval = getattr(config, 'snapshot_interval', None)
+        if snapshot_interval:
+            snapshot_thread = threading.Thread(
+                    target=snapshotter.write_every, args=(snapshot_interval,))
+            snapshot_thread.daemon = True
+            snapshot_thread.start()
+        # shut down cleanly on SIGTERM, to write the final snapshot
+        signal.signal(signal.SIGTERM, interrupt)
 
-    realtime_handler_factory.register_apps(endpoint, GRAPH_SERVER)
+    stats_interval = getattr(config, 'stats_interval', None)
+    if stats_interval:
+        stats_thread = threading.Thread(target=report_stats,
+                                        args=(cache, stats_interval))
+        stats_thread.daemon = True
+        stats_thread.start()
 
     try:
-        proxyserver.start()
+        if workers:
+            supervise_workers(workers)
+        else:
+            proxyserver.start()
     except KeyboardInterrupt:
         proxyserver.stop()
-        rtuserver.stop()
+        for server in background_servers:
+            server.stop()
+    if snapshotter:
+        snapshotter.write()
+    if capture.log:
+        capture.log.close()
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass  # already gone
+
+
+def interrupt(signum, frame):
+    """ Signal handler which stops the proxy like a KeyboardInterrupt."""
+    raise KeyboardInterrupt()
+
+
+def register_when_ready(realtime_handler_factory, endpoint, registered=None):
+    """ Subscribes all apps once the realtime endpoint accepts connections.
+
+    registered, if given, is an event set once registration has finished,
+    whether or not it succeeded.
+    """
+    try:
+        host = config.realtime_interface
+        if host in ('', '0.0.0.0'):
+            host = '127.0.0.1'
+        if not wait_for_listener(host, config.realtime_port,
+                                 getattr(config, 'startup_timeout', 30)):
+            logging.error('realtime endpoint did not come up. '
+                          'registering anyway')
+        realtime_handler_factory.register_apps(endpoint, GRAPH_SERVER)
+    finally:
+        if registered:
+            registered.set()
+
+
+def wait_for_listener(host, port, timeout):
+    """ Waits until host:port accepts connections. Returns whether it did."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+def fork_worker(config_file, cache, appdict, subscriptions):
+    """ Forks a process serving the proxy port from the shared cache.
+
+    Workers bind the proxy port with SO_REUSEPORT, so the kernel balances
+    connections across them. Returns the worker's pid in the parent.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    factory = ProxyRequestHandlerFactory(None, cache, appdict, GRAPH_SERVER,
+                                         subscriptions)
+    # the main process takes care of the shared cache and subscriptions, so
+    # workers only need to switch over to the new apps
+    watch_config(ConfigReloader(config_file, None, appdict, [factory]))
+    server = ReusePortWSGIServer((config.proxy_interface, config.proxy_port),
+                                 factory)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+    os._exit(0)
+
+
+def supervise_workers(workers):
+    """ Waits for the worker processes, returning once all have exited."""
+    remaining = set(workers)
+    while remaining:
+        try:
+            (pid, status) = os.wait()
+        except OSError, err:
+            if err.errno == errno.EINTR:  # interrupted by SIGHUP
+                continue
+            raise
+        if pid in remaining:
+            remaining.remove(pid)
+            logging.error('worker ' + str(pid) + ' exited with status ' +
+                          str(status))
+
+
+def watch_config(reloader, workers=None):
+    """ Reload the configuration on SIGHUP, and on file changes if enabled.
+
+    SIGHUP is passed on to any worker processes.
+    """
+    def on_sighup(signum, frame):
+        reloader.reload_in_background()
+        for pid in workers or []:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass  # already gone
+    signal.signal(signal.SIGHUP, on_sighup)
+
+    interval = getattr(config, 'config_poll_interval', None)
+    if interval:
+        watch_thread = threading.Thread(target=reloader.watch,
+                                        args=(interval,))
+        watch_thread.daemon = True
+        watch_thread.start()
+
+
+def make_server(bind_addr, wsgi_app):
+    """ Creates a server for wsgi_app using the configured engine."""
+    if getattr(config, 'server_engine', 'cherrypy') == 'gevent':
+        return evserver.EventLoopServer(bind_addr, wsgi_app,
+                getattr(config, 'max_connections', None))
+    return wsgiserver.CherryPyWSGIServer(bind_addr, wsgi_app)
+
+
+def make_proxy_servers(wsgi_app):
+    """ Creates the servers for the proxy endpoint.
+
+    The endpoint is served over TCP on proxy_port, over a Unix domain socket
+    at proxy_socket, or both.
+    """
+    servers = []
+    path = getattr(config, 'proxy_socket', None)
+    if path:
+        mode = getattr(config, 'proxy_socket_mode', None)
+        if getattr(config, 'server_engine', 'cherrypy') == 'gevent':
+            servers.append(evserver.EventLoopServer.from_socket(
+                    unix_socket(path, mode), wsgi_app,
+                    getattr(config, 'max_connections', None)))
+        else:
+            # refuse a path which is not a socket now, rather than from
+            # whichever thread ends up starting the server
+            remove_stale_socket(path)
+            servers.append(UnixSocketWSGIServer(path, wsgi_app, mode))
+    if getattr(config, 'proxy_port', None) is not None:
+        servers.append(make_server((getattr(config, 'proxy_interface',
+                                            '0.0.0.0'), config.proxy_port),
+                                   wsgi_app))
+    return servers
+
+
+def cache_quotas(configapps):
+    """ Builds the app id -> (entries, bytes) quota map for ProxyLruCache."""
+    quotas = {}
+    for app in configapps:
+        if 'cache_entries' in app or 'cache_bytes' in app:
+            quotas[str(app['app_id'])] = (app.get('cache_entries', 0),
+                                          app.get('cache_bytes', 0))
+    return quotas
+
+
+def make_bus():
+    """ Creates the configured InvalidationBus, if any."""
+    kind = getattr(config, 'invalidation_bus', None)
+    if not kind:
+        return None
+    options = {'batch_size': getattr(config, 'bus_batch_size', 100),
+               'batch_interval': getattr(config, 'bus_batch_interval', 0.05),
+               'heartbeat': getattr(config, 'bus_heartbeat', 1.0)}
+    if kind == 'multicast':
+        return MulticastBus(getattr(config, 'bus_group', '239.255.14.57'),
+                            getattr(config, 'bus_port', 14570),
+                            getattr(config, 'bus_ttl', 1), **options)
+    elif kind == 'tcp':
+        return TcpMeshBus((getattr(config, 'bus_interface', '0.0.0.0'),
+                           getattr(config, 'bus_port', 14570)),
+                          config.bus_peers, **options)
+    raise ValueError('unknown invalidation_bus ' + repr(kind))
+
+
+def report_stats(cache, interval):
+    """ Periodically logs the cache's per-partition statistics."""
+    while True:
+        time.sleep(interval)
+        for (name, stats) in sorted(cache.stats().iteritems()):
+            logging.info('cache partition ' + name + ': ' + repr(stats))
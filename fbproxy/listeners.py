@@ -0,0 +1,91 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Variants of the CherryPy WSGI server used by the launcher."""
+import errno
+import os
+import socket
+import stat
+from cherrypy import wsgiserver
+
+
+# not exported by the socket module on older Pythons; this is Linux's value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class ReusePortWSGIServer(wsgiserver.CherryPyWSGIServer):
+    """ A CherryPyWSGIServer whose socket is bound with SO_REUSEPORT.
+
+    This lets several worker processes listen on the same port, with the
+    kernel spreading incoming connections between them.
+    """
+    def bind(self, family, type, proto=0):
+        self.socket = socket.socket(family, type, proto)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.nodelay:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.bind(self.bind_addr)
+
+
+def remove_stale_socket(path):
+    """ Removes a socket left behind at path by an earlier run.
+
+    Raises socket.error if path is any other kind of file.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return  # nothing there yet
+    if not stat.S_ISSOCK(mode):
+        raise socket.error(errno.EEXIST, 'not a socket: ' + path)
+    os.unlink(path)
+
+
+def unix_socket(path, mode=None):
+    """ Returns a stream socket bound to the Unix domain socket path.
+
+    A socket left behind at path by an earlier run is replaced, but any other
+    kind of file is not. If mode is given, the socket file is set to it
+    before the socket starts listening, so no client can connect while it
+    still has the default permissions.
+    """
+    remove_stale_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    if mode is not None:
+        os.chmod(path, mode)
+    return sock
+
+
+class UnixSocketWSGIServer(wsgiserver.CherryPyWSGIServer):
+    """ A CherryPyWSGIServer listening on a Unix domain socket.
+
+    Connections are kept alive between requests like those over TCP, so
+    clients on the same host pay neither for TCP setup nor for the loopback
+    stack.
+    """
+    def __init__(self, path, wsgi_app, mode=None, **kwargs):
+        wsgiserver.CherryPyWSGIServer.__init__(self, path, wsgi_app, **kwargs)
+        self.mode = mode
+
+    def start(self):
+        # CherryPy's start() unlinks whatever is at bind_addr before it gets
+        # to bind(), so a file which is not a socket must be refused here
+        remove_stale_socket(self.bind_addr)
+        wsgiserver.CherryPyWSGIServer.start(self)
+
+    def bind(self, family, type, proto=0):
+        self.socket = unix_socket(self.bind_addr, self.mode)
@@ -54,7 +54,8 @@ class LRU(object):
     This LRU cache functions by containing a linked list of nodes holding
     key-value pairs, and a dictionary index into this linked list. Changes
     to the size field will get reflected the next time the list's size
-    changes (whether by a new insert or a deletion).
+    changes (whether by a new insert or a deletion). A size of None means the
+    LRU is unbounded, and the owner is responsible for calling popoldest.
     """
     def __init__(self, size=10000):
         self.count = 0
@@ -67,19 +68,26 @@ class LRU(object):
         """ fetch an item from the list, and update it's access time."""
         if key in self.index:
             node = self.index[key]
-            node.remove()
-            node.setnext(self.head)
-            return self.index[key].value
+            self.promote(node)
+            return node.value
         return None
 
+    def promote(self, node):
+        """ Move node to the head of the list."""
+        if node is self.head:
+            return
+        if node is self.tail:
+            self.tail = node.prev
+        node.remove()
+        node.setnext(self.head)
+        self.head = node
+
     def __setitem__(self, key, value):
         """ update a value or insert a new value. Also checks for fullness."""
         node = None
         if key in self.index:
             node = self.index[key]
-            node.remove()
-            node.setnext(self.head)
-            self.head = node
+            self.promote(node)
             node.value = value
         else:
             node = Node(key, value)
@@ -91,10 +99,38 @@ class LRU(object):
             self.count += 1
         self.checksize()
 
+    def append(self, key, value):
+        """ insert a new value as the least-recently-used item."""
+        del self[key]
+        node = Node(key, value)
+        self.index[key] = node
+        if self.tail:
+            self.tail.successor = node
+            node.prev = self.tail
+        else:
+            self.head = node
+        self.tail = node
+        self.count += 1
+        self.checksize()
+
     def __contains__(self, key):
         """ existence check. This does NOT update the access time."""
         return key in self.index
 
+    def peek(self, key):
+        """ fetch an item without updating its access time."""
+        if key in self.index:
+            return self.index[key].value
+        return None
+
+    def popoldest(self):
+        """ remove the least-recently-used item, returning (key, value)."""
+        node = self.tail
+        if not node:
+            return None
+        del self[node.key]
+        return (node.key, node.value)
+
     def __delitem__(self, key):
         """ remove the item from the cache. does nothing if it not found."""
         if key in self.index:
@@ -110,11 +146,26 @@ class LRU(object):
 
     def checksize(self):
         """ Prunes the LRU down to 'count' entries."""
-        print "checksize called. Current count is " + str(self.count) + " of " \
-                + str(self.size)
-        while self.count > self.size:
+        while self.size is not None and self.count > self.size:
             node = self.tail
             del self.index[node.key]
             self.tail = node.prev
+            if node is self.head:
+                self.head = None
             node.remove()
             self.count -= 1
+
+
+class FIFO(LRU):
+    """ A first-in-first-out cache with the same interface as LRU.
+
+    Lookups do not refresh an entry, so entries are evicted in the order in
+    which they were inserted.
+    """
+    def __getitem__(self, key):
+        if key in self.index:
+            return self.index[key].value
+        return None
+
+
+POLICIES = {'lru': LRU, 'fifo': FIFO}
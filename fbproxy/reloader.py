@@ -0,0 +1,133 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Reloading of the configuration while the proxy is running.
+
+A reload re-reads the config file and builds new App objects, carrying over
+the users each app has seen. The new apps are swapped into the handler
+factories in one step. Then only the cache entries which the new policies no
+longer allow are invalidated, and only apps whose policy changed are
+subscribed again. Cache sizes and listener settings still require a restart.
+"""
+import os
+import threading
+import time
+import logging
+from fbproxy import config, apps
+
+
+class ConfigReloader(object):
+    """ Reloads app policy from config_file into the running proxy.
+
+    factories are the handler factories to switch over (each must have a
+    set_apps method). If registrar is given, it is the
+    RealtimeUpdateHandlerFactory used to re-subscribe changed apps.
+    """
+    def __init__(self, config_file, cache, appdict, factories,
+                 registrar=None, endpoint=None, server=None):
+        self.config_file = config_file
+        self.cache = cache
+        self.appdict = appdict
+        self.factories = factories
+        self.registrar = registrar
+        self.endpoint = endpoint
+        self.server = server
+        self.lock = threading.Lock()
+        self.mtime = os.path.getmtime(config_file)
+
+    def reload(self):
+        """ Apply the current contents of the config file."""
+        self.lock.acquire()
+        try:
+            self.mtime = os.path.getmtime(self.config_file)
+            try:
+                config.load(self.config_file)
+                (new_apps, changed) = apps.reload(self.appdict, config.apps)
+            except Exception, err:
+                logging.error('not reloading invalid configuration: ' +
+                              str(err))
+                return
+            old_apps = self.appdict
+            self.appdict = new_apps
+            for factory in self.factories:
+                factory.set_apps(new_apps)
+            logging.info('reloaded configuration. changed apps: ' +
+                         ', '.join(sorted(changed)))
+            if self.cache and changed:
+                removed = self.cache.invalidate_where(
+                        ineligible(old_apps, new_apps, changed))
+                logging.info('invalidated ' + str(removed) +
+                             ' newly ineligible cache entries')
+            if self.registrar and changed:
+                self.registrar.register_apps(self.endpoint, self.server,
+                                             set(changed))
+        finally:
+            self.lock.release()
+
+    def reload_in_background(self, *args):
+        """ Reload on another thread. Usable as a signal handler."""
+        thread = threading.Thread(target=self.reload)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, interval):
+        """ Reload whenever the config file changes, checking every interval
+        seconds. Does not return.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                if os.path.getmtime(self.config_file) != self.mtime:
+                    self.reload()
+            except OSError, err:
+                logging.error('cannot check config file: ' + str(err))
+
+
+def ineligible(old_apps, new_apps, changed):
+    """ Builds a predicate(path, appid) matching entries the reload made
+    ineligible for caching.
+
+    Entries are keyed by the app id of the access token, and app ids without
+    settings of their own are governed by the default app. Entries of apps
+    that were removed, or newly given settings, were cached under a different
+    policy, so they are all dropped. Otherwise, user tables are dropped if the
+    set of cached or shared fields changed, and connections if they are no
+    longer cacheable or have started or stopped being shared.
+    """
+    removed = set(old_apps) - set(new_apps)
+    plans = {}
+    for (app_id, old) in changed.iteritems():
+        if app_id in removed:
+            continue
+        elif old is None:
+            plans[app_id] = (True, None)
+        else:
+            new = new_apps[app_id]
+            plans[app_id] = (old.good_fields != new.good_fields or
+                             old.shared_fields != new.shared_fields,
+                             (old.good_conns - new.good_conns) |
+                             (old.shared_conns ^ new.shared_conns))
+
+    def predicate(path, appid):
+        if appid in removed:
+            return True
+        policy = appid if appid in new_apps else 'default'
+        if not policy in plans:
+            return False
+        (fields_changed, dropped_conns) = plans[policy]
+        if '/' not in path:
+            return fields_changed
+        return dropped_conns is None or path.split('/', 1)[1] in dropped_conns
+    return predicate
@@ -0,0 +1,185 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Offline cache simulator for captured traffic (see fbproxy.capture).
+
+Replays a capture through the real ProxyLruCache, LRU and HashedDictionary
+code, with a stub standing in for the Graph API, once for every combination
+of cache size and eviction policy asked for. For each run it reports the hit
+ratio, the estimated bytes held by the cache at the end and at its peak, and
+the replay speed. This is meant for sizing cache_entries and cache_bytes.
+"""
+import multiprocessing
+import optparse
+import time
+from fbproxy import capture
+from fbproxy.apps import App
+from fbproxy.cache import ProxyLruCache
+from fbproxy.lru import POLICIES
+
+# the field names standing in for the bits of captured field masks
+FIELDS = ['f%d' % x for x in xrange(32)]
+
+
+class StubUpstream(object):
+    """ Stands in for the Graph API when replaying a capture.
+
+    Responses have the size captured for their path since it was last
+    invalidated, and only change when the path is invalidated, so identical
+    responses are deduplicated by HashedDictionary just like real ones.
+    Connections are answered with a one-object list, so that the cache stores
+    them as lists.
+    """
+    def __init__(self):
+        self.sizes = {}
+        self.versions = {}
+        self.paths = {}  # user -> paths seen for the user
+        self.fetches = 0
+
+    def seen(self, path, nbytes):
+        """ Records the response size of path, if not known already."""
+        if not path in self.sizes:
+            self.sizes[path] = nbytes
+            self.paths.setdefault(path.split('/', 1)[0], set()).add(path)
+
+    def invalidate(self, path):
+        """ Changes the response for path."""
+        self.versions[path] = self.versions.get(path, 0) + 1
+        self.sizes.pop(path, None)
+
+    def __call__(self, path, querystring, server, app_id=None):
+        self.fetches += 1
+        head = '{"id": "%s", "v": %d, "pad": "' % (path,
+                                                  self.versions.get(path, 0))
+        tail = '"}'
+        if '/' in path:
+            (head, tail) = ('{"data": [' + head, tail + ']}')
+        pad = max(0, self.sizes.get(path, 0) - len(head) - len(tail))
+        return ('200 OK', [('Content-Type', 'text/javascript')],
+                head + 'x' * pad + tail, 200)
+
+
+def simulate(events, size, policy='lru', max_bytes=None, sample_every=1000):
+    """ Replays events through a fresh cache. Returns a dict of results."""
+    cache = ProxyLruCache(size, max_bytes, policy=policy)
+    upstream = StubUpstream()
+    cache.fetch = upstream
+    apps = {}
+    partitions = cache._all_partitions()
+    requests = passthrough = 0
+    peak = 0
+    started = time.time()
+    for (count, event) in enumerate(events):
+        (kind, flags, _, app, viewer, obj, conn, query, fields, nbytes) = \
+                event
+        path = 'o%x' % obj
+        if conn:
+            path += '/c%x' % conn
+        appid = 'a%x' % app
+        if kind == capture.INVALIDATION:
+            upstream.invalidate(path)
+            cache.invalidate(appid, path)
+            continue
+        elif kind == capture.USER_INVALIDATION:
+            uid = 'o%x' % obj
+            if flags & capture.ALL_PATHS:
+                for user_path in upstream.paths.get(uid, ()):
+                    upstream.invalidate(user_path)
+                cache.invalidate_user(uid)
+            else:
+                upstream.invalidate(path)
+                cache.invalidate_user(uid, [path])
+            continue
+        elif kind == capture.FIELD_INVALIDATION:
+            upstream.invalidate(path)
+            cache.invalidate_fields(path, _fields(fields))
+            continue
+        requests += 1
+        if not flags & capture.CACHEABLE:
+            passthrough += 1
+            continue
+        upstream.seen(path, nbytes)
+        params = {}
+        if app:
+            params['access_token'] = [appid + '|r-u%x|s' % viewer]
+        if query:
+            params['q'] = ['%x' % query]
+        if fields:
+            params['fields'] = [','.join(_fields(fields))]
+        if not appid in apps:
+            apps[appid] = App({'app_id': appid, 'whitelist_fields': FIELDS})
+        cache.handle_request(params, path, '', apps[appid], None)
+        if count % sample_every == 0:
+            peak = max(peak, sum(x.bytes for x in partitions))
+    elapsed = time.time() - started
+    hits = sum(x.hits for x in partitions)
+    lookups = hits + sum(x.misses for x in partitions)
+    final = sum(x.bytes for x in partitions)
+    return {'policy': policy,
+            'size': size,
+            'requests': requests,
+            'passthrough': passthrough,
+            'hit_ratio': float(hits) / lookups if lookups else 0.0,
+            'fetches': upstream.fetches,
+            'bytes': final,
+            'peak_bytes': max(peak, final),
+            'events_per_sec': len(events) / elapsed if elapsed else 0.0}
+
+
+def _fields(mask):
+    """ The field names for the bits set in a captured field mask."""
+    return [FIELDS[x] for x in xrange(32) if mask & (1 << x)]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+            usage='usage: %prog [options] capture_file')
+    parser.add_option('-s', '--sizes', default='1000,10000,100000',
+                      help='comma-separated cache_entries values to try')
+    parser.add_option('-p', '--policies', default='lru',
+                      help='comma-separated eviction policies to try (' +
+                           ', '.join(sorted(POLICIES)) + ')')
+    parser.add_option('-b', '--max-bytes', type='int', default=None,
+                      help='cache_bytes limit to simulate')
+    parser.add_option('-j', '--jobs', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='number of simulations to run in parallel')
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected exactly one capture file')
+    global _events
+    _events = list(capture.read(args[0]))
+    print 'loaded ' + str(len(_events)) + ' events'
+    runs = [(int(size), policy, options.max_bytes) for policy in
+            options.policies.split(',') for size in options.sizes.split(',')]
+    # the workers are forked after loading, so they share the events
+    pool = multiprocessing.Pool(min(options.jobs, len(runs)))
+    results = pool.map(_simulate_run, runs)
+    pool.close()
+    print '%-6s %10s %10s %9s %12s %12s %10s' % ('policy', 'size',
+            'requests', 'hit_ratio', 'bytes', 'peak_bytes', 'events/s')
+    for result in results:
+        print '%-6s %10d %10d %9.4f %12d %12d %10d' % (result['policy'],
+                result['size'], result['requests'], result['hit_ratio'],
+                result['bytes'], result['peak_bytes'],
+                result['events_per_sec'])
+    return 0
+
+
+_events = None
+
+
+def _simulate_run(run):
+    return simulate(_events, *run)
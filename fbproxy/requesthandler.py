@@ -15,14 +15,43 @@
 
 """ WSGI application for the proxy endpoint."""
 import httplib
+import json
 import urlparse
 import logging
+from fbproxy import admission, capture, hedge
 
 USER_FIELDS = ['first_name', 'last_name', 'name', 'hometown', 'location',
                'about', 'bio', 'relationship_status', 'significant_other',
                'work', 'education', 'gender']
-INVALIDATE_MAP = {'feed': ['statuses', 'feed', 'links'],
-                  'links': ['feed', 'links']}
+# path on the proxy port reporting the proxy's state, rather than proxied
+HEALTH_PATH = '/_fbproxy/health'
+# headers which describe a single connection, and so must not be relayed
+HOP_HEADERS = set(['connection', 'keep-alive', 'proxy-authenticate',
+                   'proxy-authorization', 'te', 'trailers',
+                   'transfer-encoding', 'upgrade'])
+
+
+def strip_hop_headers(headers):
+    """ Returns headers without any hop-by-hop headers."""
+    return [x for x in headers if x[0].lower() not in HOP_HEADERS]
+
+
+def framed_headers(headers, body):
+    """ Returns headers for relaying body over a persistent connection.
+
+    Hop-by-hop headers are dropped and the Content-Length set to that of
+    body, so the connection can be reused for the client's next request.
+    """
+    return [x for x in strip_hop_headers(headers)
+            if x[0].lower() != 'content-length'] + \
+           [('Content-Length', str(len(body)))]
+
+
+def rejected_response():
+    """ The response for a request refused by the admission controller."""
+    return (admission.controller.reject_status,
+            [('Content-type', 'text/plain')],
+            "The Graph API is overloaded. Try again later\n")
 
 
 class ProxyRequestHandler(object):
@@ -41,22 +70,25 @@ class ProxyRequestHandler(object):
     4. The request fails the application's check_request() verification.
     5. The request is not for a user or a direct connection of user
     6. A validator is present and the request fails its validation
+    7. The application's realtime subscription is not (yet) in place
 
     For requests which are not GET requests, we also proactively invalidate
     cache entries which are likely to be affected by such requests. See
     ProxyLruCache for details about the caching strategy.
     """
     def __init__(self, environ, start_response, validator, cache, appdict,
-                 server):
+                 server, subscriptions=None):
         self.start = start_response
         self.env = environ
         self.cache = cache
         self.apps = appdict
         self.server = server
+        self.subscriptions = subscriptions
         # the following fields will be set in __iter__
         self.uriparts = None
         self.acctoken_pieces = None
         self.query_parms = None
+        self.app = None
         if validator:
             self.validate = validator
 
@@ -93,6 +125,7 @@ class ProxyRequestHandler(object):
             logging.info('bypassing cache due to missing application settings')
             return self.pass_through()  # app is missing from config, so don't
                                         # cache
+        self.app = app
         # non-GETs typically change the results of subsequent GETs. Thus we
         # invalidate opportunistically.
         if self.env['REQUEST_METHOD'] != 'GET':
@@ -111,6 +144,9 @@ class ProxyRequestHandler(object):
         if not app.check_request(self.uriparts, fields):
             logging.info('bypassing cache since the app rejected the request')
             return self.pass_through()
+        if self.subscriptions and not self.subscriptions.ready(app.id):
+            logging.info('bypassing cache since the app is not subscribed')
+            return self.pass_through()
 
         if self.cache:
             return self.do_cache(app, self.server)
@@ -142,6 +178,37 @@ class ProxyRequestHandler(object):
         response = conn.getresponse()
         return response
 
+    @staticmethod
+    def fetch(reqtype, path, querystring, server, app_id=None, fill=False):
+        """ fetch the requested object as (status, headers, body, status num)
+
+        If an admission controller is configured, the request waits for an
+        upstream slot first (cache fills ahead of pass-through requests), and
+        admission.UpstreamRejected is raised if none frees up in time. Cache
+        fills are hedged if a hedger is configured.
+        """
+        limiter = admission.controller
+        if limiter:
+            started = limiter.acquire(app_id, fill)
+        status = None
+        body = ''
+        try:
+            if fill and reqtype == 'GET' and hedge.hedger:
+                (statusline, headers, body, status) = hedge.hedger.fetch(
+                        path, querystring, server, app_id)
+            else:
+                response = ProxyRequestHandler.fetchurl(reqtype, path,
+                                                        querystring, server)
+                statusline = str(response.status) + " " + response.reason
+                headers = response.getheaders()
+                body = response.read()
+                response.close()
+                status = response.status
+        finally:
+            if limiter:
+                limiter.release(app_id, started, status, body)
+        return (statusline, headers, body, status)
+
     # connections which are known not to work with the Graph API.
     # See http://developers.facebook.com/docs/api/realtime for details
     connections_blacklist = ['home', 'tagged', 'posts', 'likes', 'photos', \
@@ -173,21 +240,39 @@ class ProxyRequestHandler(object):
 
     def pass_through(self):
         """ Satisfy a request by just proxying it to the Graph API server."""
-        response = self.fetchurl(self.env['REQUEST_METHOD'],
-                self.env['PATH_INFO'], self.env['QUERY_STRING'], self.server)
-        self.start(str(response.status) + " " +
-                response.reason, response.getheaders())
-        data = response.read()
-        response.close()
+        try:
+            (statusline, headers, data, _) = self.fetch(
+                    self.env['REQUEST_METHOD'], self.env['PATH_INFO'],
+                    self.env['QUERY_STRING'], self.server,
+                    self.app.id if self.app else None)
+        except admission.UpstreamRejected:
+            (statusline, headers, data) = rejected_response()
+        self.capture(self.query_parms, False, data)
+        self.start(statusline, framed_headers(headers, data))
         yield data
 
     def do_cache(self, app, server):
         """ Satisfy a request by passing it to the Cache."""
-        cached_response = self.cache.handle_request(self.query_parms,
-                self.env['PATH_INFO'], self.env['QUERY_STRING'], app, server)
-        self.start(cached_response[0], cached_response[1])
+        # the cache consumes the query, so keep a copy for the capture log
+        query = dict(self.query_parms) if capture.log else None
+        try:
+            cached_response = self.cache.handle_request(self.query_parms,
+                    self.env['PATH_INFO'], self.env['QUERY_STRING'], app,
+                    server)
+        except admission.UpstreamRejected:
+            cached_response = rejected_response()
+        self.capture(query, True, cached_response[2])
+        self.start(cached_response[0],
+                   framed_headers(cached_response[1], cached_response[2]))
         yield cached_response[2]
 
+    def capture(self, query, cacheable, body):
+        """ Record this request in the capture log, if there is one."""
+        if capture.log:
+            capture.log.record_request(
+                    self.acctoken_pieces or ['', '', '', ''], self.uriparts,
+                    query or {}, cacheable, len(body))
+
     def forbidden(self):
         self.start('403 Forbidden', [('Content-type', 'text/plain')])
         yield "Failed to validate request\n"
@@ -200,15 +285,16 @@ class ProxyRequestHandler(object):
     def invalidate_for_post(self, app):
         """ Invalidates possibly affected URLs after a non-GET.
 
-        The behavior of this is controlled by invalidate_map in config.py
+        A write to a user or one of their connections can change any of the
+        user's data, so all of the user's entries are dropped, for every app.
         """
-        if len(self.uriparts) != 2:
-            return
-        if not self.uriparts[1] in INVALIDATE_MAP:
+        if len(self.uriparts) > 2 or not self.uriparts[0]:
             return
-        for field in INVALIDATE_MAP[self.uriparts[1]]:
-            logging.debug('invalidating ' + self.uriparts[0] + '/' + field)
-            self.cache.invalidate(app.id, "/" + self.uriparts[0] + "/" + field)
+        uid = self.uriparts[0]
+        logging.debug('invalidating all entries for ' + uid)
+        self.cache.invalidate_user(uid)
+        if capture.log:
+            capture.log.record_user_invalidation(uid)
 
 
 class ProxyRequestHandlerFactory(object):
@@ -217,12 +303,42 @@ class ProxyRequestHandlerFactory(object):
     This is called by WSGI for each request. Note that this and any code
     called by it can be running in multiple threads at once.
     """
-    def __init__(self, validator, cache, apps, server):
+    def __init__(self, validator, cache, apps, server, subscriptions=None):
         self.validator = validator
         self.cache = cache
         self.apps = apps
         self.server = server
+        self.subscriptions = subscriptions
+
+    def set_apps(self, apps):
+        """ Atomically switch to a new app mapping (see ConfigReloader)."""
+        self.apps = apps
+
+    def health(self, start_response):
+        """ Reports subscription progress and cache statistics as JSON.
+
+        The state is 'registering' while any subscription is pending (those
+        apps are served in pass-through mode), 'degraded' if any failed, and
+        'ready' otherwise.
+        """
+        states = self.subscriptions.snapshot() if self.subscriptions else {}
+        if 'pending' in states.values():
+            state = 'registering'
+        elif 'failed' in states.values():
+            state = 'degraded'
+        else:
+            state = 'ready'
+        report = {'state': state, 'apps': states,
+                  'cache': self.cache.stats() if self.cache else {}}
+        if hedge.hedger:
+            report['hedging'] = hedge.hedger.stats()
+        body = json.dumps(report)
+        start_response('200 OK', [('Content-type', 'application/json')])
+        return [body]
 
     def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == HEALTH_PATH:
+            return self.health(start_response)
         return ProxyRequestHandler(environ, start_response,
-                self.validator, self.cache, self.apps, self.server)
+                self.validator, self.cache, self.apps, self.server,
+                self.subscriptions)
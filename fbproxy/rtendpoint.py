@@ -18,8 +18,10 @@ import json
 import urlparse
 import hmac
 import hashlib
+import threading
+import time
 import logging
-from fbproxy import rturegister
+from fbproxy import rturegister, capture
 
 
 class RealtimeUpdateHandler(object):
@@ -28,7 +30,8 @@ class RealtimeUpdateHandler(object):
     This responds to two types of requests: validation requests (GET), and
     realtime updates (POST). For each user change entry in the update, if
     at least one change is for a field directly on user, that user's entry is
-    invalidated. Any connections are invalidated one by one.
+    invalidated, along with any changed connections. This happens for every
+    app, since the user's data changed for all of them.
     """
     def __init__(self, environ, start_response, validator, cache, apps):
         self.start = start_response
@@ -116,12 +119,18 @@ class RealtimeUpdateHandler(object):
         try:  # loop over all entries in the update message
             for entry in updates['entry']:
                 uid = entry['uid']
-                if len(app.good_fields.intersection(
-                        entry['changed_fields'])) > 0:
-                    self.cache.invalidate(app_id, uid)
-                conns = app.good_conns.intersection(entry['changed_fields'])
-                for conn in conns:
-                    self.cache.invalidate(app_id, uid + "/" + conn)
+                urls = [uid + "/" + conn for conn in
+                        app.good_conns.intersection(entry['changed_fields'])]
+                if urls:
+                    self.cache.invalidate_user(uid, urls)
+                    if capture.log:
+                        capture.log.record_user_invalidation(uid, urls)
+                # only the changed fields of the user's tables are refetched
+                fields = app.good_fields.intersection(entry['changed_fields'])
+                if fields:
+                    self.cache.invalidate_fields(uid, fields)
+                    if capture.log:
+                        capture.log.record_field_invalidation(uid, fields)
         except KeyError:
             return self.bad_request('Missing fields caused key error')
         return self.success('Updates successfully handled')
@@ -134,20 +143,76 @@ class RealtimeUpdateHandler(object):
 class RealtimeUpdateHandlerFactory:
     """ Creates RealtimeUpdateHandlers for the given cache and app dictionary.
     """
-    def __init__(self, cache, validator, appdict):
+    def __init__(self, cache, validator, appdict, subscriptions=None,
+                 concurrency=8, retries=3):
         self.cache = cache
         self.validator = validator
         self.appdict = appdict
+        self.subscriptions = subscriptions or rturegister.Subscriptions()
+        self.concurrency = concurrency
+        self.retries = retries
 
-    def register_apps(self, endpoint, server):
+    def set_apps(self, appdict):
+        """ Atomically switch to a new app mapping (see ConfigReloader)."""
+        self.appdict = appdict
+
+    def register_apps(self, endpoint, server, app_ids=None):
         """ Registers applications for realtime updates.
 
         This method must be called AFTER the realtime update endpoint is
         ready to accept connections. This means that the realtime update
-        endpoint should probably be run on a different thread.
+        endpoint should probably be run on a different thread. If app_ids is
+        given, only those applications are registered.
+
+        Applications are registered concurrently, and their progress is
+        recorded in self.subscriptions. Returns once all have finished.
         """
-        for app in self.appdict.itervalues():
-            rturegister.register(app, endpoint + app.id, server)
+        appdict = self.appdict
+        if app_ids is None:
+            app_ids = set(appdict)
+        targets = []
+        for app_id in app_ids:
+            if app_id in appdict:
+                self.subscriptions.set(app_id, 'pending')
+                targets.append(appdict[app_id])
+            else:
+                self.subscriptions.discard(app_id)
+        slots = threading.Semaphore(self.concurrency)
+        threads = []
+        for app in targets:
+            thread = threading.Thread(target=self._register,
+                    args=(app, endpoint + app.id, server, slots))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _register(self, app, callback, server, slots):
+        """ Registers one app, retrying with backoff on failure."""
+        slots.acquire()
+        try:
+            for attempt in xrange(self.retries):
+                try:
+                    result = rturegister.register(app, callback, server)
+                except Exception:
+                    # the app must not be left pending, or startup waits on it
+                    logging.exception('error subscribing app ' + app.id)
+                    result = False
+                if result is None:
+                    self.subscriptions.set(app.id, 'unmanaged')
+                    return
+                elif result:
+                    logging.info('subscribed app ' + app.id)
+                    self.subscriptions.set(app.id, 'subscribed')
+                    return
+                if attempt + 1 < self.retries:
+                    time.sleep(2 ** attempt)
+            logging.error('giving up subscribing app ' + app.id +
+                          '. requests for it will bypass the cache')
+            self.subscriptions.set(app.id, 'failed')
+        finally:
+            slots.release()
 
     def __call__(self, environ, start_response):
         return RealtimeUpdateHandler(environ, start_response,
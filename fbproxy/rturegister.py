@@ -20,11 +20,67 @@ and the app object, and registers for realtime updates if either the app's
 cred or secret is available and valid.
 """
 import httplib
+import socket
+import threading
 import urllib
 import random
 
 
-randtoken = 0
+# a random number used as our verification token
+randtoken = random.randint(1, 1000000000)
+# seconds a subscription request may take before it counts as failed
+REGISTER_TIMEOUT = 30
+
+
+class Subscriptions(object):
+    """ Tracks the realtime update subscription state of each app.
+
+    The states are 'pending' (not registered yet), 'subscribed', 'failed' and
+    'unmanaged' (the app has no credentials, so its subscription is managed
+    elsewhere). Requests are only served from the cache for apps which are
+    ready, i.e. subscribed or unmanaged, since we would miss the updates for
+    any other app.
+    """
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def set(self, app_id, state):
+        self.lock.acquire()
+        self.states[app_id] = state
+        self.lock.release()
+
+    def discard(self, app_id):
+        self.lock.acquire()
+        self.states.pop(app_id, None)
+        self.lock.release()
+
+    def ready(self, app_id):
+        return self.states.get(app_id) in ('subscribed', 'unmanaged')
+
+    def snapshot(self):
+        """ Returns a copy of the app id -> state mapping."""
+        self.lock.acquire()
+        states = dict(self.states)
+        self.lock.release()
+        return states
+
+
+class StartupGate(object):
+    """ Subscription state for worker processes.
+
+    Workers cannot see the main process' Subscriptions, so they treat every
+    app as pending until the main process has finished its initial round of
+    registrations and set the shared event.
+    """
+    def __init__(self, event):
+        self.event = event
+
+    def ready(self, app_id):
+        return self.event.is_set()
+
+    def snapshot(self):
+        return {'*': 'subscribed' if self.event.is_set() else 'pending'}
 
 
 def register_with_secret(appid, secret, fields, callback, server):
@@ -51,20 +107,19 @@ def register_with_token(appid, token, fields, callback, server):
     """
     fieldstr = ",".join(fields)
     headers = {'Content-type': 'applocation/x-www-form-urlencoded'}
-    # use a random number as our verification token
-    global randtoken
-    if not randtoken:
-        randtoken = random.randint(1, 1000000000)
-
     # make a POST to the graph API to register the endpoint
     postfields = {'object': 'user',
                   'fields': fieldstr,
                   'callback_url': callback,
                   'verify_token': randtoken}
-    conn = httplib.HTTPSConnection(server)
-    conn.request('POST', appid + '/subscriptions?access_token=' + token,
-            urllib.urlencode(postfields), headers)
-    response = conn.getresponse()
+    conn = httplib.HTTPSConnection(server, timeout=REGISTER_TIMEOUT)
+    try:
+        conn.request('POST', appid + '/subscriptions?access_token=' + token,
+                urllib.urlencode(postfields), headers)
+        response = conn.getresponse()
+    except (socket.error, httplib.HTTPException), err:
+        print 'Error subscribing: ' + str(err)
+        return False
     if response.status == 200:
         return True
     else:
@@ -79,11 +134,14 @@ def register(app, callback, server):
     """ Registers the given App, if possible.
 
     For registration to be possible, at least one of app.cred or app.secret
-    must be defined.
+    must be defined. Returns whether registration succeeded, or None if it
+    was not possible.
     """
     subscribefields = app.good_fields | app.good_conns
     if app.cred:
-        register_with_token(app.id, app.cred, subscribefields, callback, server)
+        return register_with_token(app.id, app.cred, subscribefields,
+                                   callback, server)
     elif app.secret:
-        register_with_secret(app.id, app.secret, subscribefields, callback,
-                             server)
+        return register_with_secret(app.id, app.secret, subscribefields,
+                                    callback, server)
+    return None
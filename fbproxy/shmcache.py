@@ -0,0 +1,287 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" This module contains the SharedMemoryCache class.
+
+SharedMemoryCache keeps all of its state in one anonymous shared mmap, so a
+cache created before forking is shared by the parent and all its worker
+processes. The mapping holds three regions:
+
+    generations - a table of counters indexed by a hash of path + appid,
+        of a path alone or of a user id. An entry is recorded under the sum
+        of the counters for its key, its path and its user. Invalidating
+        simply bumps a counter, which makes every entry recorded under the
+        old sum stale at once.
+    slots - an open-addressed hash table from a fingerprint of the full
+        (key, subkey) pair to the position of its record in the arena.
+    arena - a circular log of records (full key, status and headers, body).
+        New records overwrite the oldest ones, so eviction is FIFO and free.
+"""
+import hashlib
+import json
+import mmap
+import multiprocessing
+import struct
+import urllib
+import logging
+from fbproxy.requesthandler import ProxyRequestHandler
+from fbproxy.hashdict import HashedDictionary
+from fbproxy.cache import fetch_tuple, get_response, key_uid, _fetchtable
+
+
+HEADER = struct.Struct('<QQQ')  # arena head, hits, misses
+GENERATION = struct.Struct('<Q')
+SLOT = struct.Struct('<QQIQ')  # fingerprint, arena position, length, gen
+RECORD = struct.Struct('<III')  # key length, meta length, body length
+PROBES = 8
+
+
+class SharedMemoryCache(object):
+    """ A Graph API response cache shared between processes.
+
+    Unlike ProxyLruCache, entries are complete responses: the subkey includes
+    the requested fields, and user tables are rendered before being stored.
+    This keeps hits free of JSON parsing, which is the point of running
+    several workers. Implements the same handle_request/invalidate interface
+    as ProxyLruCache.
+    """
+    def __init__(self, slots=262144, arena_bytes=256 * 1024 * 1024,
+                 generations=65536):
+        self.slots = slots
+        self.generations = generations
+        self.arena_bytes = arena_bytes
+        self.gen_base = HEADER.size
+        self.slot_base = self.gen_base + generations * GENERATION.size
+        self.arena_base = self.slot_base + slots * SLOT.size
+        self.mem = mmap.mmap(-1, self.arena_base + arena_bytes)
+        self.lock = multiprocessing.Lock()
+
+    def handle_request(self, query, path, querystring, app, server):
+        """ handle a cacheable request. returns (status, headers, data) tuple.
+        """
+        accesstoken_parts = None
+        accesstoken = None
+        if 'access_token' in query:
+            accesstoken = query['access_token'][0]
+            accesstoken_parts = ProxyRequestHandler.parse_access_token(
+                    accesstoken)
+            del query['access_token']
+        appid = accesstoken_parts[0] if accesstoken_parts else '0'
+        uid = accesstoken_parts[2] if accesstoken_parts else '0'
+
+        fields = query['fields'][0] if 'fields' in query else None
+        shared = app.is_shared(path.split('/'),
+                               fields.split(',') if fields else None)
+        key = path + "__" + appid
+        fullkey = key + "\0" + ('*' if shared else uid) + "__" + \
+                urllib.urlencode(query)
+        (value, gen) = self.lookup(key, fullkey)
+        if value:
+            return value
+
+        if '/' not in path:  # user tables are fetched with all good fields
+            if 'fields' in query:
+                del query['fields']
+            (statusline, headers, table, status) = _fetchtable(query, path,
+                    accesstoken, app, HashedDictionary(), fullkey, server,
+                    app.shared_fields if shared else None)
+            if status != 200:
+                body = table
+            else:
+                headers = [x for x in headers
+                           if x[0].upper() != 'CONTENT-LENGTH']
+                body = get_response(table, fields)
+        else:
+            (statusline, headers, body, status) = fetch_tuple(path,
+                    querystring, server, app.id)
+        if status == 200:
+            self.store(key, fullkey, gen, statusline, headers, body)
+        return (statusline, headers, body)
+
+    def lookup(self, key, fullkey):
+        """ Looks up fullkey, returning (response, generation).
+
+        response is the cached (status, headers, body), or None. generation
+        is key's generation at the time of the lookup, to be passed to store.
+        """
+        fingerprint = _fingerprint(fullkey)
+        record = None
+        self.lock.acquire()
+        try:
+            gen = self._generation(key)
+            (head, hits, misses) = HEADER.unpack_from(self.mem, 0)
+            for slot in self._probe(fingerprint):
+                (fpr, pos, length, slotgen) = SLOT.unpack_from(self.mem, slot)
+                if fpr != fingerprint or slotgen != gen:
+                    continue
+                if pos + self.arena_bytes < head:
+                    continue  # overwritten by newer records
+                start = self.arena_base + pos % self.arena_bytes
+                record = self.mem[start:start + length]
+                break
+            if record:
+                hits += 1
+            else:
+                misses += 1
+            HEADER.pack_into(self.mem, 0, head, hits, misses)
+        finally:
+            self.lock.release()
+        if not record:
+            return (None, gen)
+        (keylen, metalen, bodylen) = RECORD.unpack_from(record, 0)
+        offset = RECORD.size
+        if record[offset:offset + keylen] != fullkey:
+            return (None, gen)  # fingerprint collision
+        offset += keylen
+        (statusline, headers) = json.loads(record[offset:offset + metalen])
+        headers = [(str(name), str(value)) for (name, value) in headers]
+        offset += metalen
+        return ((str(statusline), headers, record[offset:offset + bodylen]),
+                gen)
+
+    def store(self, key, fullkey, gen, statusline, headers, body):
+        """ Appends a response to the arena and points fullkey's slot at it.
+
+        gen is key's generation from before the response was fetched. If it
+        has changed since, the response may predate an invalidation, so it is
+        not stored.
+        """
+        meta = json.dumps([statusline, headers])
+        length = RECORD.size + len(fullkey) + len(meta) + len(body)
+        if length > self.arena_bytes:
+            return
+        fingerprint = _fingerprint(fullkey)
+        self.lock.acquire()
+        try:
+            if self._generation(key) != gen:
+                logging.debug('not storing ' + key + ', invalidated while '
+                              'it was being fetched')
+                return
+            (head, hits, misses) = HEADER.unpack_from(self.mem, 0)
+            if head % self.arena_bytes + length > self.arena_bytes:
+                # records never straddle the end of the arena
+                head += self.arena_bytes - head % self.arena_bytes
+            start = self.arena_base + head % self.arena_bytes
+            RECORD.pack_into(self.mem, start, len(fullkey), len(meta),
+                             len(body))
+            start += RECORD.size
+            self.mem[start:start + len(fullkey)] = fullkey
+            start += len(fullkey)
+            self.mem[start:start + len(meta)] = meta
+            start += len(meta)
+            self.mem[start:start + len(body)] = body
+            target = None
+            for slot in self._probe(fingerprint):
+                (fpr, pos, _, _) = SLOT.unpack_from(self.mem, slot)
+                if fpr == fingerprint or fpr == 0 or \
+                        pos + self.arena_bytes < head:
+                    target = slot
+                    break
+            if target is None:
+                target = self._probe(fingerprint)[0]
+            SLOT.pack_into(self.mem, target, fingerprint, head, length, gen)
+            HEADER.pack_into(self.mem, 0, head + length, hits, misses)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, appid, url):
+        """ Invalidate a URL in an application's context.
+
+        This makes all entries for the given application and path stale, as
+        well as those of the URL for the null app.
+        """
+        logging.debug('invalidating ' + url + "__" + appid)
+        self.lock.acquire()
+        try:
+            for key in (url + "__" + appid, url + "__0"):
+                self._bump(key)
+        finally:
+            self.lock.release()
+
+    def invalidate_user(self, uid, paths=None):
+        """ Invalidate a user's entries for every app.
+
+        paths, if given, limits this to the given paths of the user.
+        """
+        logging.debug('invalidating entries for user ' + uid)
+        self.lock.acquire()
+        try:
+            if paths is None:
+                self._bump('\0user\0' + uid)
+            else:
+                for path in paths:
+                    self._bump('\0path\0' + path)
+        finally:
+            self.lock.release()
+
+    def invalidate_fields(self, uid, fields):
+        """ Invalidate a user's tables for every app.
+
+        Tables are stored here as rendered responses, which cannot be partly
+        refetched, so they are dropped whichever fields changed.
+        """
+        self.invalidate_user(uid, [uid])
+
+    def invalidate_where(self, predicate):
+        """ Entries cannot be enumerated here, so this clears the cache."""
+        self.clear()
+
+    def clear(self):
+        """ Drop every entry from the cache."""
+        self.lock.acquire()
+        try:
+            self.mem[self.slot_base:self.arena_base] = \
+                    '\0' * (self.arena_base - self.slot_base)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Returns hit rate and occupancy figures for the shared cache."""
+        (head, hits, misses) = HEADER.unpack_from(self.mem, 0)
+        lookups = hits + misses
+        return {'shared': {
+            'bytes': min(head, self.arena_bytes),
+            'quota_bytes': self.arena_bytes,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / lookups if lookups else 0.0}}
+
+    def _generation_offset(self, key):
+        index = _fingerprint(key) % self.generations
+        return self.gen_base + index * GENERATION.size
+
+    def _counter(self, name):
+        return GENERATION.unpack_from(self.mem,
+                                      self._generation_offset(name))[0]
+
+    def _bump(self, name):
+        GENERATION.pack_into(self.mem, self._generation_offset(name),
+                             self._counter(name) + 1)
+
+    def _generation(self, key):
+        """ The sum of the counters for key, its path and its user."""
+        return self._counter(key) + \
+                self._counter('\0path\0' + key.rsplit('__', 1)[0]) + \
+                self._counter('\0user\0' + key_uid(key))
+
+    def _probe(self, fingerprint):
+        first = fingerprint % self.slots
+        return [self.slot_base + ((first + i) % self.slots) * SLOT.size
+                for i in xrange(PROBES)]
+
+
+def _fingerprint(value):
+    """ A non-zero 64-bit hash of value. Zero marks an empty slot."""
+    return struct.unpack('<Q', hashlib.sha1(value).digest()[:8])[0] or 1
@@ -0,0 +1,137 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" This module contains the SlabArena class.
+
+A SlabArena stores byte strings outside of the Python heap, in an mmap of
+fixed size. The mmap is split into pages, and each page is carved into
+chunks of one power-of-two size class when first needed, as in memcached.
+Callers keep only a small SlabHandle per string, and read it back as a
+zero-copy buffer over the mmap. Since memory is never handed back to the
+Python allocator, the cache's footprint stays fixed however much it churns.
+
+Every chunk is exposed through a ctypes array of its own, which the buffers
+over it refer to. A released chunk is only reused once no buffer refers to
+its array any more, so a buffer stays valid for as long as it is kept.
+"""
+import bisect
+import ctypes
+import mmap
+import sys
+import threading
+
+
+class SlabHandle(object):
+    """ The location of a string stored in a SlabArena."""
+    __slots__ = ('offset', 'length', 'chunk')
+
+    def __init__(self, offset, length, chunk):
+        self.offset = offset
+        self.length = length
+        self.chunk = chunk  # the ctypes array over the string's bytes
+
+
+class SlabArena(object):
+    """ Size-classed storage for byte strings in an mmap.
+
+    If path is given, the arena is backed by that file rather than by
+    anonymous memory. Released chunks are only reused once the views taken
+    of them are gone, so views can be handed out to be written to clients.
+    A handle must not be viewed once it has been released.
+    """
+    def __init__(self, size, path=None, page_size=1 << 20, min_chunk=64):
+        self.page_size = page_size
+        self.pages = max(1, size // page_size)
+        length = self.pages * page_size
+        if path:
+            backing = open(path, 'w+b')
+            backing.truncate(length)
+            self.mem = mmap.mmap(backing.fileno(), length)
+            backing.close()
+        else:
+            self.mem = mmap.mmap(-1, length)
+        self.classes = []
+        chunk = min_chunk
+        while chunk <= page_size:
+            self.classes.append(chunk)
+            chunk *= 2
+        self.free = dict((x, []) for x in self.classes)
+        self.next_page = 0
+        self.released = []  # handles of chunks which may still be viewed
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        """ Copies data into the arena. Returns its handle, or None if there
+        is no room for it.
+        """
+        length = len(data)
+        if not length or length > self.page_size:
+            return None
+        chunk = self._class_for(length)
+        self.lock.acquire()
+        try:
+            self._reclaim()
+            if not self.free[chunk] and self.next_page < self.pages:
+                base = self.next_page * self.page_size
+                self.free[chunk] = range(base + self.page_size - chunk,
+                                         base - 1, -chunk)
+                self.next_page += 1
+            if not self.free[chunk]:
+                return None
+            offset = self.free[chunk].pop()
+            self.used += chunk
+        finally:
+            self.lock.release()
+        self.mem[offset:offset + length] = data
+        return SlabHandle(offset, length,
+                (ctypes.c_char * length).from_buffer(self.mem, offset))
+
+    def view(self, handle):
+        """ Returns the stored string as a read-only buffer (no copy)."""
+        return buffer(handle.chunk)
+
+    def release(self, handle):
+        """ Frees a handle's chunk, once no view of it is left."""
+        self.lock.acquire()
+        try:
+            self.released.append(handle)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'bytes': self.used,
+                'capacity': self.pages * self.page_size,
+                'pages_used': self.next_page,
+                'released': len(self.released)}
+
+    def _class_for(self, length):
+        return self.classes[bisect.bisect_left(self.classes, length)]
+
+    def _reclaim(self):
+        """ Return released chunks which are no longer viewed to the free
+        lists. The caller must hold self.lock.
+        """
+        viewed = []
+        for handle in self.released:
+            # only handle.chunk and the argument refer to an unviewed array
+            if sys.getrefcount(handle.chunk) > 2:
+                viewed.append(handle)
+                continue
+            handle.chunk = None
+            chunk = self._class_for(handle.length)
+            self.free[chunk].append(handle.offset)
+            self.used -= chunk
+        self.released = viewed
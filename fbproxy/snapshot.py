@@ -0,0 +1,266 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Snapshots of the cache, for a warm start after a restart.
+
+A snapshot file starts with a header and a record of every app's cached
+and shared fields and connections and its known users. Then follows one
+record per cache entry, each partition's most recently used entries first:
+
+    payload length, created, key length (see ENTRY), key, payload
+
+where the payload is the marshalled HashedDictionary.dump() of the entry.
+Snapshots are written to a temporary file which then replaces the previous
+one, so a crash while writing leaves the previous snapshot in place.
+
+On startup, the snapshot is mapped into memory and only the record headers
+are read. Entries are then restored in the background, or right away when
+they are requested. The proxy may have missed realtime updates while it was
+down, so no entries are restored from a snapshot written more than max_age
+seconds ago, and entries of apps whose settings changed meanwhile are
+skipped.
+"""
+import logging
+import marshal
+import mmap
+import os
+import struct
+import time
+from fbproxy.apps import App
+from fbproxy.cache import key_uid
+from fbproxy.hashdict import HashedDictionary
+from fbproxy.reloader import ineligible
+
+MAGIC = 'FBPXSNAP'
+VERSION = 4
+
+# magic, version, time written
+HEADER = struct.Struct('<8sId')
+# length of the apps record
+LENGTH = struct.Struct('<I')
+# payload length, time created, key length
+ENTRY = struct.Struct('<IdH')
+
+
+class Snapshot(object):
+    """ A snapshot file opened for restoring into a cache.
+
+    Only entries which are still valid for the apps in appdict are kept.
+    Entries are handed out by take() at most once, and discard() drops
+    entries which have been invalidated since the start. The owner must
+    serialize calls to these, as ProxyLruCache does with its lock.
+    """
+    def __init__(self, path, appdict, max_age=None):
+        self.file = open(path, 'rb')
+        try:
+            self.mem = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):  # an empty file cannot be mapped
+            self.file.close()
+            raise ValueError('not a cache snapshot: ' + path)
+        try:
+            self._read_index(appdict, max_age)
+        except (ValueError, EOFError, TypeError, struct.error):
+            self.close()
+            raise ValueError('not a cache snapshot: ' + path)
+
+    def _read_index(self, appdict, max_age):
+        (magic, version, self.written) = HEADER.unpack_from(self.mem, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError()
+        offset = HEADER.size
+        (length,) = LENGTH.unpack_from(self.mem, offset)
+        offset += LENGTH.size
+        self.apps = {}
+        for (app_id, fields, conns, shared_fields, shared_conns, users) in \
+                marshal.loads(self.mem[offset:offset + length]):
+            app = App({'app_id': app_id})
+            app.good_fields = set(fields)
+            app.good_conns = set(conns)
+            app.shared_fields = set(shared_fields)
+            app.shared_conns = set(shared_conns)
+            app.users = set(users)
+            self.apps[app_id] = app
+        offset += length
+
+        changed = {}
+        for app_id in set(self.apps) | set(appdict):
+            old = self.apps.get(app_id)
+            new = appdict.get(app_id)
+            if not old or not new or old.good_fields != new.good_fields or \
+                    old.good_conns != new.good_conns or \
+                    old.shared_fields != new.shared_fields or \
+                    old.shared_conns != new.shared_conns:
+                changed[app_id] = old
+        stale = ineligible(self.apps, appdict, changed)
+
+        self.index = {}
+        self.order = []
+        self.users = {}
+        end = len(self.mem)
+        if max_age and time.time() - self.written > max_age:
+            logging.info('cache snapshot is too old to restore entries from')
+            end = offset
+        while offset + ENTRY.size <= end:
+            (length, _, keylen) = ENTRY.unpack_from(self.mem, offset)
+            start = offset + ENTRY.size + keylen
+            if start + length > end:
+                break  # truncated
+            key = self.mem[offset + ENTRY.size:start]
+            offset = start + length
+            if stale(*key.rsplit('__', 1)):
+                continue
+            self.index[key] = (start, length)
+            self.order.append(key)
+            self.users.setdefault(key_uid(key), []).append(key)
+
+    def restore_users(self, appdict):
+        """ Adds the known users of each app to the same app in appdict."""
+        for (app_id, saved) in self.apps.iteritems():
+            app = appdict.get(app_id)
+            if app:
+                app.lock.acquire()
+                app.users.update(saved.users)
+                app.lock.release()
+
+    def keys(self):
+        """ Returns the keys of the entries, in the order of the file."""
+        return list(self.order)
+
+    def take(self, key, arena=None):
+        """ Returns the HashedDictionary for key, removing it from the
+        snapshot, or None if there is none.
+        """
+        if key not in self.index:
+            return None
+        (offset, length) = self.index.pop(key)
+        return HashedDictionary.load(
+                marshal.loads(self.mem[offset:offset + length]), arena)
+
+    def discard(self, key):
+        """ Drops the entry for key, if there is one."""
+        self.index.pop(key, None)
+
+    def discard_user(self, uid, paths=None):
+        """ Drops the entries of uid, or only those for the given paths."""
+        kept = []
+        for key in self.users.pop(uid, ()):
+            if paths is None or key.rsplit('__', 1)[0] in paths:
+                self.index.pop(key, None)
+            else:
+                kept.append(key)
+        if kept:
+            self.users[uid] = kept
+
+    def discard_where(self, predicate):
+        """ Drops every entry for which predicate(path, appid) is true."""
+        for key in self.index.keys():
+            if predicate(*key.rsplit('__', 1)):
+                del self.index[key]
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.mem.close()
+        self.file.close()
+
+
+class Snapshotter(object):
+    """ Writes snapshots of a ProxyLruCache, and of the apps' known users.
+
+    Like the handler factories, it is switched to new apps by set_apps when
+    the configuration is reloaded.
+    """
+    def __init__(self, path, cache, appdict):
+        self.path = path
+        self.cache = cache
+        self.appdict = appdict
+
+    def set_apps(self, apps):
+        self.appdict = apps
+
+    def write(self):
+        """ Writes a snapshot to the path, replacing the previous one.
+
+        Returns the number of entries written, or None if no snapshot was
+        written: while a snapshot is still being loaded, writing another
+        would lose the entries not restored yet.
+        """
+        if self.cache.snapshot:
+            logging.info('not writing a snapshot while loading one')
+            return None
+        tmppath = self.path + '.tmp'
+        written = 0
+        try:
+            out = open(tmppath, 'wb', 1 << 16)
+            try:
+                out.write(HEADER.pack(MAGIC, VERSION, time.time()))
+                apps = marshal.dumps(
+                        [self._dump_app(x) for x in self.appdict.values()])
+                out.write(LENGTH.pack(len(apps)))
+                out.write(apps)
+                for (key, hashdict) in self.cache.entries():
+                    dumped = hashdict.dump()
+                    if dumped is None or not dumped[1]:
+                        continue  # evicted since listed, or all stale
+                    payload = marshal.dumps(dumped)
+                    out.write(ENTRY.pack(len(payload), dumped[0], len(key)))
+                    out.write(key)
+                    out.write(payload)
+                    written += 1
+            finally:
+                out.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError, ValueError), err:
+            logging.error('cannot write cache snapshot: ' + str(err))
+            return None
+        logging.info('wrote ' + str(written) + ' entries to cache snapshot')
+        return written
+
+    @staticmethod
+    def _dump_app(app):
+        app.lock.acquire()
+        users = list(app.users)
+        app.lock.release()
+        return (app.id, list(app.good_fields), list(app.good_conns),
+                list(app.shared_fields), list(app.shared_conns), users)
+
+    def write_every(self, interval):
+        """ Writes a snapshot every interval seconds. Does not return."""
+        while True:
+            time.sleep(interval)
+            self.write()
+
+
+def warm(cache, path, appdict, max_age=None):
+    """ Restores the snapshot at path, if any, into cache and appdict.
+
+    This returns once all entries are restored, so it should run on its own
+    thread; the cache serves requests meanwhile.
+    """
+    try:
+        snapshot = Snapshot(path, appdict, max_age)
+    except (IOError, ValueError), err:
+        logging.warning('not restoring cache snapshot: ' + str(err))
+        return
+    snapshot.restore_users(appdict)
+    logging.info('restoring ' + str(len(snapshot)) + ' entries from ' +
+                 'cache snapshot')
+    try:
+        restored = cache.warm(snapshot)
+    finally:
+        snapshot.close()
+    logging.info('restored ' + str(restored) + ' entries from cache snapshot')
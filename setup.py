@@ -7,7 +7,7 @@ setup(  name = 'fbproxy',
         author_email = 'yuliyp@facebook.com',
         url = 'http://www.facebook.com/',
         packages = ['fbproxy'],
-        scripts = ['start_proxy'],
+        scripts = ['start_proxy', 'replay_capture'],
         data_files = [('.', ['config.sample'])],
         requires = ['cherrypy.wsgiserver'],
         provides = ['fbproxy']
@@ -0,0 +1,89 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for AdmissionController."""
+import threading
+import time
+import unittest
+from fbproxy.admission import AdmissionController, AimdLimit, \
+        UpstreamRejected, is_throttled
+
+
+class AimdLimitTest(unittest.TestCase):
+    def test_increase_and_decrease(self):
+        limit = AimdLimit(8, minimum=2)
+        limit.on_overload(100.0)
+        self.assertEqual(limit.limit, 4)
+        limit.on_overload(100.5)  # within the cooldown of the last cut
+        self.assertEqual(limit.limit, 4)
+        limit.on_success()
+        self.assertEqual(limit.limit, 4.25)
+        for now in (102.0, 104.0, 106.0):
+            limit.on_overload(now)
+        self.assertEqual(limit.limit, 2)
+        for _ in xrange(100):
+            limit.on_success()
+        self.assertEqual(limit.limit, 8)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_slow_and_throttled_responses_cut_limits(self):
+        controller = AdmissionController(8, app_limit=4, latency_target=0.5)
+        controller.release('1', controller.acquire('1'), 200, '')
+        self.assertEqual(controller.apps['1'].limit, 4)
+        controller.release('1', controller.acquire('1') - 1, 200, '')
+        self.assertEqual(controller.total.limit, 4)
+        self.assertEqual(controller.apps['1'].limit, 2)
+        self.assertTrue(is_throttled(400, '{"error": {"code": 613}}'))
+        self.assertFalse(is_throttled(404, '{"error": {"code": 803}}'))
+
+    def test_cancelled_requests_leave_limits(self):
+        controller = AdmissionController(2)
+        controller.release(None, controller.acquire(), None, '', True)
+        self.assertEqual(controller.total.limit, 2)
+        self.assertEqual(controller.total.inflight, 0)
+
+    def test_queue_timeout(self):
+        controller = AdmissionController(1, queue_timeout=0.01)
+        controller.acquire()
+        self.assertRaises(UpstreamRejected, controller.acquire)
+        self.assertEqual(controller.try_acquire(), None)
+        self.assertEqual(controller.total.inflight, 1)
+
+    def test_fills_go_first(self):
+        controller = AdmissionController(1, queue_timeout=5)
+        started = controller.acquire()
+        admitted = []
+
+        def request(fill):
+            begun = controller.acquire(fill=fill)
+            admitted.append(fill)
+            controller.release(None, begun, 200, '')
+        passthrough = threading.Thread(target=request, args=(False,))
+        passthrough.start()
+        time.sleep(0.05)  # the pass-through request queues first
+        fill = threading.Thread(target=request, args=(True,))
+        fill.start()
+        while not controller.waiting_fills:
+            time.sleep(0.01)
+        self.assertEqual(controller.try_acquire(), None)
+        controller.release(None, started, 200, '')
+        passthrough.join(5)
+        fill.join(5)
+        self.assertEqual(admitted, [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
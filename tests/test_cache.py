@@ -0,0 +1,221 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for ProxyLruCache."""
+import json
+import unittest
+import urllib
+import urlparse
+from fbproxy.apps import App
+from fbproxy.cache import ProxyLruCache
+from fbproxy.slab import SlabArena
+
+
+class FakeGraph(object):
+    """ Stands in for the Graph API, serving users from a dictionary."""
+    def __init__(self, users):
+        self.users = users
+        self.requests = []
+
+    def fetch(self, path, querystring, server, app_id=None):
+        query = urlparse.parse_qs(querystring)
+        if '/' in path:
+            return self.fetch_connection(path, query)
+        fields = query['fields'][0].split(',')
+        self.requests.append((path, sorted(fields)))
+        user = self.users[path]
+        body = dict((x, user[x]) for x in fields if x in user)
+        body['id'] = path
+        return ('200 OK', [('Content-type', 'text/javascript')],
+                json.dumps(body), 200)
+
+    def fetch_connection(self, path, query):
+        self.requests.append((path, query))
+        (uid, conn) = path.split('/')
+        objects = self.users[uid][conn]
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['2'])[0])  # the default page
+        body = {'data': objects[offset:offset + limit]}
+        if offset + limit < len(objects):
+            body['paging'] = {'next': 'more'}
+        return ('200 OK', [('Content-type', 'text/javascript')],
+                json.dumps(body), 200)
+
+
+class CacheTestCase(unittest.TestCase):
+    fields = ['name', 'email', 'hometown']
+
+    def setUp(self):
+        self.app = App({'app_id': '1', 'whitelist_fields': self.fields})
+        self.graph = FakeGraph({})
+        self.cache = ProxyLruCache(2)
+        self.cache.fetch = self.graph.fetch
+
+    def add_user(self, uid, **fields):
+        self.graph.users[uid] = dict(fields, id=uid)
+
+    def get(self, path, fields=None, viewer='7', **params):
+        query = {'access_token': ['1|x-' + viewer + '|y']}
+        if fields:
+            query['fields'] = [fields]
+        for (name, value) in params.iteritems():
+            query[name] = [str(value)]
+        response = self.cache.handle_request(query, path,
+                urllib.urlencode(query, True), self.app,
+                'graph.facebook.com')
+        return json.loads(str(response[2]))
+
+
+class EvictionTest(CacheTestCase):
+    def test_hit_on_oldest_then_evict(self):
+        for uid in '123':
+            self.add_user(uid, name=uid)
+        self.get('1')
+        self.get('2')
+        self.get('1')  # 2 is now the oldest
+        self.get('3')
+        self.assertEqual(self.cache.shared.lru.count, 2)
+        self.assertTrue('1__1' in self.cache.shared.lru)
+        self.assertFalse('2__1' in self.cache.shared.lru)
+        requests = len(self.graph.requests)
+        self.get('1')
+        self.assertEqual(len(self.graph.requests), requests)
+
+    def test_lock_released_on_error(self):
+        self.add_user('1', name='a')
+        self.assertRaises(KeyError, self.get, '2')
+        self.assertFalse(self.cache.lock.locked())
+        self.assertEqual(self.get('1')['name'], 'a')
+
+
+class StaleFieldTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.add_user('1', name='a', email='e', hometown='h')
+        self.get('1', viewer='1')
+        self.user = self.graph.users['1']
+
+    def last_request(self):
+        return self.graph.requests[-1][1]
+
+    def test_only_stale_fields_are_refetched(self):
+        self.user['name'] = 'b'
+        self.assertEqual(self.cache.invalidate_fields('1', ['name']), 1)
+        requests = len(self.graph.requests)
+        self.assertEqual(self.get('1', 'email', viewer='1'), {'email': 'e'})
+        self.assertEqual(len(self.graph.requests), requests)
+        self.assertEqual(self.get('1', viewer='1'), self.user)
+        self.assertEqual(self.last_request(), ['name'])
+        self.get('1', viewer='1')
+        self.assertEqual(len(self.graph.requests), requests + 1)
+
+    def test_removed_field(self):
+        del self.user['hometown']
+        self.cache.invalidate_fields('1', ['hometown'])
+        self.assertEqual(self.get('1', 'name,hometown', viewer='1'),
+                         {'name': 'a'})
+        self.assertEqual(self.last_request(), ['hometown'])
+
+    def test_other_fields_and_users_stay_fresh(self):
+        self.add_user('2', name='z')
+        self.get('2', viewer='2')
+        self.cache.invalidate_fields('2', ['name'])
+        requests = len(self.graph.requests)
+        self.get('1', viewer='1')
+        self.assertEqual(len(self.graph.requests), requests)
+
+    def test_refreshes_do_not_grow_entry(self):
+        hashdict = self.cache.shared.lru.peek('1__1')
+        for version in xrange(50):
+            self.user['name'] = 'n' + str(version)
+            self.cache.invalidate_fields('1', ['name'])
+            self.assertEqual(self.get('1', 'name', viewer='1')['name'],
+                             self.user['name'])
+        self.assertEqual(len(hashdict.content), 1)
+        self.assertEqual(self.cache.shared.bytes, hashdict.nbytes)
+
+
+class ConnectionTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.cache.list_limit = 3
+        self.add_user('1', likes=[{'id': str(x), 'name': 'n' + str(x)}
+                                  for x in xrange(5)])
+
+    def fetches(self, path, **params):
+        before = len(self.graph.requests)
+        response = self.get(path, **params)
+        return (len(self.graph.requests) - before, response)
+
+    def test_pages_from_one_list(self):
+        (fetches, response) = self.fetches('1/likes', limit=2)
+        self.assertEqual(fetches, 1)
+        self.assertEqual([x['id'] for x in response['data']], ['0', '1'])
+        (fetches, response) = self.fetches('1/likes', limit=1, offset=2)
+        self.assertEqual(fetches, 0)
+        self.assertEqual([x['id'] for x in response['data']], ['2'])
+
+    def test_truncated_list_passes_through_once(self):
+        self.fetches('1/likes', limit=2)
+        (fetches, response) = self.fetches('1/likes', limit=2, offset=2)
+        self.assertEqual(fetches, 1)
+        self.assertEqual([x['id'] for x in response['data']], ['2', '3'])
+        (fetches, _) = self.fetches('1/likes', fields='name', offset=3,
+                                    limit=2)
+        self.assertEqual(fetches, 2)  # the list with names, then the page
+        (fetches, _) = self.fetches('1/likes', fields='name', offset=3,
+                                    limit=2)
+        self.assertEqual(fetches, 1)
+
+    def test_same_body_other_fields(self):
+        self.add_user('2', likes=[])
+        self.assertEqual(self.fetches('2/likes', limit=2)[0], 1)
+        self.assertEqual(self.fetches('2/likes', fields='name',
+                                      limit=2)[0], 1)
+        self.assertEqual(self.fetches('2/likes', fields='name',
+                                      limit=2)[0], 0)
+
+    def test_unpaged_requests_stored_as_is(self):
+        (fetches, response) = self.fetches('1/likes')
+        self.assertEqual(fetches, 1)
+        self.assertEqual(response['paging'], {'next': 'more'})
+        self.assertEqual(self.fetches('1/likes'), (0, response))
+        self.assertEqual(self.fetches('1/likes', offset=2)[0], 1)
+        self.assertEqual(self.fetches('1/likes', fields='name')[0], 1)
+        (fetches, response) = self.fetches('1/likes', limit=3)
+        self.assertEqual(fetches, 1)  # the list is stored apart
+        self.assertEqual(len(response['data']), 3)
+
+
+class ArenaTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.cache.arena = SlabArena(1 << 16, page_size=1 << 12)
+        self.add_user('1', name='a', email='e', likes=[{'id': '8'}])
+
+    def test_bodies_served_from_arena(self):
+        for attempt in xrange(2):
+            self.assertEqual(self.get('1', 'name'), {'name': 'a'})
+            self.assertEqual(self.get('1/likes')['data'], [{'id': '8'}])
+        self.assertEqual(len(self.graph.requests), 2)
+        hashdict = self.cache.shared.lru.peek('1__1')
+        self.assertEqual(hashdict.rendered.values()[0].keys(), ['name'])
+        self.assertEqual(self.cache.stats()['arena']['bytes'], 2 * 64)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['arena']['released'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for HashRing and ClusterCache."""
+import socket
+import unittest
+from fbproxy.apps import App
+from fbproxy.cluster import ClusterCache, HashRing
+
+NODES = ['10.0.0.1:8080', '10.0.0.2:8080', '10.0.0.3:8080']
+KEYS = ['%d__1' % x for x in xrange(1000)]
+
+
+class FakeCache(object):
+    """ Records the calls made to a local cache."""
+    def __init__(self):
+        self.calls = []
+
+    def handle_request(self, query, path, querystring, app, server):
+        self.calls.append(('request', path))
+        return ('200 OK', [], 'local')
+
+    def invalidate(self, appid, url):
+        self.calls.append(('invalidate', url))
+
+
+class HashRingTest(unittest.TestCase):
+    def test_owners(self):
+        owners = [HashRing(NODES).owner(x) for x in KEYS[:10]]
+        ring = HashRing(reversed(NODES))  # the same on every node
+        self.assertEqual(owners, [ring.owner(x) for x in KEYS[:10]])
+        owners = [ring.owner(x) for x in KEYS]
+        for node in NODES:  # roughly a third each
+            self.assertTrue(200 < owners.count(node) < 470)
+
+    def test_removing_a_node_moves_only_its_keys(self):
+        ring = HashRing(NODES)
+        smaller = HashRing(NODES[:2])
+        for key in KEYS:
+            if ring.owner(key) != NODES[2]:
+                self.assertEqual(smaller.owner(key), ring.owner(key))
+
+
+class ClusterCacheTest(unittest.TestCase):
+    def setUp(self):
+        # a port nothing listens on, so the peer is unreachable
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        peer = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        self.local = FakeCache()
+        self.cache = ClusterCache(self.local, [peer, 'self:1'], 'self:1',
+                                  timeout=1)
+        self.app = App({'app_id': '1'})
+        self.mine = [x for x in KEYS if self.cache.ring.owner(x) == 'self:1']
+        self.theirs = [x for x in KEYS if self.cache.ring.owner(x) == peer]
+
+    def request(self, key):
+        path = key.rsplit('__', 1)[0]
+        return self.cache.handle_request(
+                {'access_token': ['1|x-7|y']}, path,
+                'access_token=1%7Cx-7%7Cy', self.app, 'graph.facebook.com')
+
+    def test_own_keys_are_served_locally(self):
+        self.assertEqual(self.request(self.mine[0])[2], 'local')
+        self.assertEqual(self.local.calls,
+                         [('request', self.mine[0].rsplit('__', 1)[0])])
+
+    def test_unreachable_owner_falls_back_to_local(self):
+        self.assertEqual(self.request(self.theirs[0])[2], 'local')
+        self.assertEqual(len(self.local.calls), 1)
+
+    def test_invalidations_go_to_owners(self):
+        paths = [x.rsplit('__', 1)[0] for x in self.mine]
+        path = [x for x in paths
+                if self.cache.ring.owner(x + '__0') == 'self:1'][0]
+        self.cache.invalidate('1', path)
+        self.assertEqual(self.local.calls, [('invalidate', path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
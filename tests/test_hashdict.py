@@ -0,0 +1,149 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for HashedDictionary."""
+import unittest
+from fbproxy.hashdict import HashedDictionary
+from fbproxy.slab import SlabArena
+
+TABLE = ('200 OK', [('Content-type', 'text/javascript')],
+         {u'id': u'7', u'name': u'a'})
+CONNECTION = ('200 OK', [], (None, True, [{u'id': u'8'}, {u'id': u'9'}]))
+
+
+class ContentTest(unittest.TestCase):
+    def test_replaced_content_is_dropped(self):
+        hashdict = HashedDictionary()
+        hashdict.store('a', 'x' * 100, lambda: ('', [], {u'v': 0}))
+        size = hashdict.nbytes
+        for version in xrange(1, 200):
+            body = str(version).ljust(100)
+            hashdict.store('a', body, lambda: ('', [], {u'v': version}))
+        self.assertEqual(len(hashdict.content), 1)
+        self.assertEqual(hashdict.nbytes, size)
+        self.assertEqual(hashdict['a'][2], {u'v': 199})
+
+    def test_shared_content_is_kept(self):
+        hashdict = HashedDictionary()
+        hashdict.store('a', 'body', lambda: TABLE)
+        hashdict.store('b', 'body', lambda: TABLE)
+        hashdict.store('a', 'other', lambda: CONNECTION)
+        self.assertEqual(len(hashdict.content), 2)
+        self.assertEqual(hashdict['b'], TABLE)
+        hashdict.store('b', 'other', lambda: CONNECTION)
+        self.assertEqual(len(hashdict.content), 1)
+
+
+class StaleTest(unittest.TestCase):
+    def test_marks(self):
+        hashdict = HashedDictionary()
+        hashdict.store('a', 'body', lambda: TABLE)
+        hashdict.refreshed('a', ['name', 'email'], hashdict.marks)
+        self.assertEqual(hashdict.stale_fields('a'), set())
+        hashdict.mark_stale(['name'])
+        hashdict.mark_stale(['email'])
+        self.assertEqual(hashdict.stale_fields('a'), set(['name', 'email']))
+        hashdict.refreshed('a', ['name'], hashdict.marks, True)
+        self.assertEqual(hashdict.stale_fields('a'), set(['email']))
+        hashdict.refreshed('a', ['email'], hashdict.marks, True)
+        self.assertEqual(hashdict.stale_fields('a'), set())
+
+    def test_mark_during_fetch(self):
+        hashdict = HashedDictionary()
+        hashdict.store('a', 'body', lambda: TABLE)
+        hashdict.mark_stale(['name'])
+        marks = hashdict.marks  # a refetch of name starts
+        hashdict.mark_stale(['name'])
+        hashdict.refreshed('a', ['name'], marks, True)
+        self.assertEqual(hashdict.stale_fields('a'), set(['name']))
+
+    def test_dump_leaves_out_stale(self):
+        hashdict = HashedDictionary()
+        hashdict.store('a', 'body', lambda: TABLE)
+        hashdict.store('b', 'other', lambda: TABLE)
+        hashdict.refreshed('b', ['name'], hashdict.marks)
+        hashdict.mark_stale(['name'])
+        hashdict.refreshed('b', ['name'], hashdict.marks, True)
+        loaded = HashedDictionary.load(hashdict.dump())
+        self.assertFalse('a' in loaded)
+        self.assertEqual(loaded['b'], TABLE)
+        self.assertEqual(loaded.content.keys(), [hashdict.keymap['b']])
+
+
+class ArenaTest(unittest.TestCase):
+    def setUp(self):
+        self.arena = SlabArena(1 << 16, page_size=1 << 12)
+
+    def store_body(self, hashdict, key, body):
+        hashdict.store(key, body, lambda: ('200 OK', [], body))
+
+    def test_only_bodies_in_arena(self):
+        hashdict = HashedDictionary(self.arena)
+        hashdict.store('a', '{"id":"7"}', lambda: TABLE)
+        self.store_body(hashdict, 'b', '{"data":[]}')
+        self.assertTrue(hashdict['a'][2] is TABLE[2])
+        self.assertTrue(isinstance(hashdict['b'][2], buffer))
+        self.assertEqual(str(hashdict['b'][2]), '{"data":[]}')
+        self.assertEqual(self.arena.stats()['bytes'], 64)
+
+    def test_rendered_bodies(self):
+        hashdict = HashedDictionary(self.arena)
+        hashdict.store('a', 'body', lambda: TABLE)
+        (_, valhash) = hashdict.lookup('a')
+        self.assertEqual(hashdict.rendered_body(valhash, 'name'), None)
+        hashdict.keep_rendered(valhash, 'name', '{"name": "a"}')
+        self.assertEqual(str(hashdict.rendered_body(valhash, 'name')),
+                         '{"name": "a"}')
+        hashdict.store('a', 'other', lambda: TABLE)
+        self.assertEqual(hashdict.rendered, {})
+        self.assertEqual(self.arena.stats()['released'], 1)
+
+    def test_views_outlive_release(self):
+        hashdict = HashedDictionary(self.arena)
+        self.store_body(hashdict, 'a', 'x' * 10)
+        offset = hashdict.content.values()[0][-1].offset
+        view = hashdict['a'][2]
+        hashdict.release()
+        self.assertEqual(hashdict['a'], None)
+        other = HashedDictionary(self.arena)
+        self.store_body(other, 'a', 'y' * 10)
+        self.assertNotEqual(other.content.values()[0][-1].offset, offset)
+        self.assertEqual(str(view), 'x' * 10)
+        del view
+        self.store_body(other, 'b', 'z' * 10)
+        self.assertEqual(other.content[other.keymap['b']][-1].offset, offset)
+
+    def test_store_after_release(self):
+        hashdict = HashedDictionary(self.arena)
+        self.store_body(hashdict, 'a', 'body')
+        hashdict.release()
+        self.store_body(hashdict, 'a', 'body')
+        self.assertEqual(hashdict['a'][2], 'body')
+
+    def test_dump_and_load(self):
+        hashdict = HashedDictionary(self.arena)
+        hashdict.store('a', '{"id":"7"}', lambda: TABLE)
+        self.store_body(hashdict, 'b', 'body')
+        dumped = hashdict.dump()
+        self.assertEqual(dumped[2][hashdict.keymap['b']][2], 'body')
+        loaded = HashedDictionary.load(dumped, self.arena)
+        self.assertEqual(loaded['a'], TABLE)
+        self.assertEqual(str(loaded['b'][2]), 'body')
+        hashdict.release()
+        self.assertEqual(hashdict.dump(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for Hedger."""
+import socket
+import threading
+import time
+import unittest
+from fbproxy import admission, hedge
+
+
+class FakeAttempt(object):
+    """ Stands in for hedge.Attempt. Each attempt takes the next of `plans`,
+    a (seconds, body) pair, and returns body after that many seconds unless
+    it is cancelled first.
+    """
+    plans = []
+
+    def __init__(self, path, querystring, server):
+        (self.seconds, self.body) = FakeAttempt.plans.pop(0)
+        self.cancelled = threading.Event()
+
+    def run(self):
+        if self.cancelled.wait(self.seconds):
+            raise socket.error('cancelled')
+        return ('200 OK', [], self.body, 200)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class HedgeTest(unittest.TestCase):
+    def setUp(self):
+        self.attempt = hedge.Attempt
+        hedge.Attempt = FakeAttempt
+        FakeAttempt.plans = []
+
+    def tearDown(self):
+        hedge.Attempt = self.attempt
+        admission.controller = None
+
+    def hedger(self, **kwargs):
+        hedger = hedge.Hedger(**kwargs)
+        hedger.delay = 0.01
+        return hedger
+
+    def fetch(self, hedger, *plans):
+        FakeAttempt.plans = list(plans)
+        return hedger.fetch('7', 'fields=name', 'graph.facebook.com')[2]
+
+    def test_race(self):
+        race = hedge.Race()
+        self.assertTrue(race.finish('primary', ('a', None)))
+        self.assertFalse(race.finish('hedge', ('b', None)))
+        self.assertFalse(race.start_hedge('hedge'))
+        self.assertEqual(race.outcome, ('a', None))
+
+    def test_hedge_wins(self):
+        hedger = self.hedger()
+        self.assertEqual(self.fetch(hedger, (5, 'primary'), (0, 'hedge')),
+                         'hedge')
+        self.assertEqual(hedger.stats()['wins'], 1)
+
+    def test_fast_primary_is_not_hedged(self):
+        hedger = self.hedger()
+        hedger.delay = 0.05
+        self.assertEqual(self.fetch(hedger, (0, 'primary')), 'primary')
+        time.sleep(0.1)
+        self.assertEqual(hedger.stats()['hedges'], 0)
+
+    def test_token_budget(self):
+        hedger = self.hedger(budget=0.25, burst=1)
+        for _ in xrange(5):
+            self.assertEqual(self.fetch(hedger, (0.1, 'primary'),
+                                        (5, 'hedge')), 'primary')
+        self.assertEqual(hedger.stats()['hedges'], 2)
+
+    def test_cancelled_hedge_frees_its_slot(self):
+        admission.controller = admission.AdmissionController(4)
+        hedger = self.hedger()
+        self.fetch(hedger, (0.1, 'primary'), (5, 'hedge'))
+        deadline = time.time() + 5
+        while admission.controller.total.inflight and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(admission.controller.total.inflight, 0)
+        self.assertEqual(admission.controller.total.limit, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
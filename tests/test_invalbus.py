@@ -0,0 +1,134 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for InvalidationBus and BroadcastCache."""
+import json
+import threading
+import unittest
+from fbproxy.invalbus import BroadcastCache, InvalidationBus
+
+
+class FakeCache(object):
+    """ Records the invalidations applied to a cache."""
+    def __init__(self):
+        self.calls = []
+
+    def invalidate(self, appid, url):
+        self.calls.append(('url', appid, url))
+
+    def invalidate_user(self, uid, paths=None):
+        self.calls.append(('user', uid, paths))
+
+    def invalidate_fields(self, uid, fields):
+        self.calls.append(('fields', uid, fields))
+
+    def clear(self):
+        self.calls.append(('clear',))
+
+
+class StopSending(Exception):
+    pass
+
+
+class RecordingBus(InvalidationBus):
+    """ A bus which keeps the packets it sends, and receives nothing.
+
+    Sending stops (by raising StopSending) after `limit` packets.
+    """
+    def __init__(self, limit=None, **kwargs):
+        InvalidationBus.__init__(self, **kwargs)
+        self.limit = limit
+        self.sent = []
+
+    def send(self, packet):
+        self.sent.append(json.loads(packet))
+        if len(self.sent) == self.limit:
+            raise StopSending()
+
+    def send_all(self):
+        try:
+            self._send_loop()
+        except StopSending:
+            pass
+
+    def start(self, cache):
+        self.cache = cache
+
+
+class ApplyTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeCache()
+        self.bus = RecordingBus()
+        self.bus.start(self.cache)
+
+    def test_items_are_applied(self):
+        self.bus.apply('a', 1, [['url', '1', '7'], ['user', '7', None],
+                                ['fields', '7', ['name']]])
+        self.assertEqual(self.cache.calls, [('url', '1', '7'),
+                                            ('user', '7', None),
+                                            ('fields', '7', ['name'])])
+
+    def test_gap_flushes(self):
+        self.bus.apply('a', 1, [['url', '1', '7']])
+        self.bus.apply('a', 2, [['url', '1', '8']])
+        self.bus.apply('a', 2, [])  # a heartbeat
+        self.assertFalse(('clear',) in self.cache.calls)
+        self.bus.apply('a', 4, [['url', '1', '9']])  # 3 was lost
+        self.assertEqual(self.cache.calls[-2:],
+                         [('clear',), ('url', '1', '9')])
+        self.bus.apply('a', 5, [['url', '1', '7']])
+        self.assertEqual(self.cache.calls.count(('clear',)), 1)
+
+    def test_heartbeat_reveals_lost_batch(self):
+        self.bus.apply('a', 1, [['url', '1', '7']])
+        self.bus.apply('a', 2, [])
+        self.assertEqual(self.cache.calls[-1], ('clear',))
+
+    def test_senders_are_tracked_apart(self):
+        self.bus.apply('a', 5, [['url', '1', '7']])
+        self.bus.apply('b', 1, [['url', '1', '8']])
+        self.bus.apply('a', 5, [])
+        self.bus.apply('b', 2, [['url', '1', '9']])
+        self.bus.apply('a', 6, [['url', '1', '9']])
+        self.assertFalse(('clear',) in self.cache.calls)
+
+    def test_own_packets_are_ignored(self):
+        self.bus.apply(self.bus.node, 1, [['url', '1', '7']])
+        self.assertEqual(self.cache.calls, [])
+
+
+class SendTest(unittest.TestCase):
+    def test_batches_are_numbered(self):
+        cache = FakeCache()
+        bus = RecordingBus(3, batch_size=2, batch_interval=0.01,
+                           heartbeat=0)
+        broadcast = BroadcastCache(cache, bus)
+        broadcast.invalidate('1', '7')
+        broadcast.invalidate_user('7', ['7/likes'])
+        broadcast.invalidate_fields('7', set(['name']))
+        thread = threading.Thread(target=bus.send_all)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)  # two batches, then a heartbeat
+        self.assertEqual(len(cache.calls), 3)
+        self.assertEqual([(x['seq'], x['items']) for x in bus.sent[:2]],
+                         [(1, [['url', '1', '7'], ['user', '7', ['7/likes']]]),
+                          (2, [['fields', '7', ['name']]])])
+        self.assertEqual(bus.sent[2]['items'], [])
+        self.assertEqual(bus.sent[2]['seq'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
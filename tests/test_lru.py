@@ -0,0 +1,92 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for the LRU and FIFO caches."""
+import unittest
+from fbproxy.lru import LRU, FIFO
+
+
+def keys(lru):
+    """ The keys of lru from most to least recently used."""
+    ret = []
+    node = lru.head
+    while node:
+        ret.append(node.key)
+        node = node.successor
+    return ret
+
+
+class LRUTest(unittest.TestCase):
+    def test_hit_on_oldest_moves_tail(self):
+        lru = LRU(None)
+        lru['a'] = 1
+        lru['b'] = 2
+        self.assertEqual(lru['a'], 1)
+        self.assertEqual(keys(lru), ['a', 'b'])
+        self.assertEqual(lru.popoldest(), ('b', 2))
+        self.assertEqual(lru.popoldest(), ('a', 1))
+        self.assertEqual(lru.popoldest(), None)
+        self.assertEqual(lru.count, 0)
+        self.assertEqual((lru.head, lru.tail), (None, None))
+
+    def test_hit_on_middle(self):
+        lru = LRU(None)
+        for key in 'abc':
+            lru[key] = key
+        lru['b']
+        self.assertEqual(keys(lru), ['b', 'c', 'a'])
+        self.assertEqual(lru.tail.key, 'a')
+
+    def test_update_promotes(self):
+        lru = LRU(None)
+        lru['a'] = 1
+        lru['b'] = 2
+        lru['a'] = 3
+        self.assertEqual(keys(lru), ['a', 'b'])
+        self.assertEqual(lru.popoldest(), ('b', 2))
+
+    def test_append_is_oldest(self):
+        lru = LRU(None)
+        lru['a'] = 1
+        lru.append('b', 2)
+        self.assertEqual(keys(lru), ['a', 'b'])
+        self.assertEqual(lru.popoldest(), ('b', 2))
+
+    def test_bounded(self):
+        lru = LRU(2)
+        for key in 'abc':
+            lru[key] = key
+        self.assertEqual(keys(lru), ['c', 'b'])
+        lru.size = 0
+        lru.checksize()
+        self.assertEqual((lru.head, lru.tail, lru.count), (None, None, 0))
+
+    def test_peek_does_not_promote(self):
+        lru = LRU(None)
+        lru['a'] = 1
+        lru['b'] = 2
+        self.assertEqual(lru.peek('a'), 1)
+        self.assertEqual(lru.popoldest(), ('a', 1))
+
+    def test_fifo_ignores_hits(self):
+        fifo = FIFO(None)
+        fifo['a'] = 1
+        fifo['b'] = 2
+        self.assertEqual(fifo['a'], 1)
+        self.assertEqual(fifo.popoldest(), ('a', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for traffic capture and the replay simulator."""
+import os
+import shutil
+import tempfile
+import unittest
+from fbproxy import capture, replay
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'capture')
+        self.log = capture.CaptureLog(self.path)
+        self.log.salt = 'a fixed salt'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def request(self, obj, conn=None, viewer='7', cacheable=True,
+                fields=None):
+        uriparts = [obj] + ([conn] if conn else [])
+        query = {'access_token': ['t']}
+        if fields:
+            query['fields'] = [fields]
+        self.log.record_request(['1', 'x', viewer, 'y'], uriparts, query,
+                                cacheable, 100)
+
+    def events(self):
+        self.log.close()
+        return list(capture.read(self.path))
+
+    def test_round_trip(self):
+        self.request('7')
+        self.log.record_invalidation('1', '7/likes')
+        events = self.events()
+        self.assertEqual([x[0] for x in events],
+                         [capture.REQUEST, capture.INVALIDATION])
+        self.assertEqual(events[0][-1], 100)
+        self.assertNotEqual(events[1][6], 0)  # the connection
+
+    def test_records_written_at_once(self):
+        self.request('7')
+        self.assertEqual(os.path.getsize(self.path), capture.RECORD.size)
+        self.log.close()
+        self.request('7')  # dropped once closed
+        self.assertEqual(os.path.getsize(self.path), capture.RECORD.size)
+
+    def test_simulate(self):
+        for _ in xrange(3):
+            self.request('7')
+            self.request('7', 'likes')
+        self.request('8', cacheable=False)
+        self.log.record_invalidation('1', '7')
+        self.request('7')
+        result = replay.simulate(self.events(), 10)
+        self.assertEqual(result['requests'], 8)
+        self.assertEqual(result['passthrough'], 1)
+        self.assertEqual(result['fetches'], 3)
+        self.assertAlmostEqual(result['hit_ratio'], 4 / 7.0)
+
+    def test_user_invalidations(self):
+        self.request('7')
+        self.request('7', 'likes')
+        self.request('7', 'friends')
+        self.log.record_user_invalidation('7', ['7/likes'])
+        self.request('7')
+        self.request('7', 'likes')
+        self.request('7', 'friends')
+        self.log.record_user_invalidation('7')
+        self.request('7')
+        self.request('7', 'friends')
+        result = replay.simulate(self.events(), 10)
+        self.assertEqual(result['fetches'], 6)
+
+    def test_field_invalidations(self):
+        self.assertNotEqual(self.log.field_mask(['name']),
+                            self.log.field_mask(['email']))
+        self.request('7')
+        self.log.record_field_invalidation('7', ['name'])
+        self.request('7', fields='email')  # still fresh
+        self.request('7', fields='name,email')  # refetches name only
+        self.request('7', fields='name')
+        events = self.events()
+        self.assertEqual(events[1][0], capture.FIELD_INVALIDATION)
+        result = replay.simulate(events, 10)
+        self.assertEqual(result['fetches'], 2)
+        self.assertAlmostEqual(result['hit_ratio'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
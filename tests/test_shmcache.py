@@ -0,0 +1,65 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for SharedMemoryCache generations."""
+import unittest
+from fbproxy.shmcache import SharedMemoryCache
+
+RESPONSE = ('200 OK', [('Content-type', 'text/javascript')], '{"id":"7"}')
+
+
+class GenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SharedMemoryCache(slots=64, arena_bytes=4096,
+                                       generations=64)
+
+    def fill(self, key, fullkey):
+        (value, gen) = self.cache.lookup(key, fullkey)
+        self.assertEqual(value, None)
+        return gen
+
+    def test_store_and_hit(self):
+        gen = self.fill('7__1', '7__1\0x')
+        self.cache.store('7__1', '7__1\0x', gen, *RESPONSE)
+        self.assertEqual(self.cache.lookup('7__1', '7__1\0x')[0], RESPONSE)
+
+    def test_invalidations(self):
+        for (key, invalidate) in [
+                ('7__1', lambda: self.cache.invalidate('1', '7')),
+                ('7__1', lambda: self.cache.invalidate_user('7')),
+                ('7/likes__1',
+                 lambda: self.cache.invalidate_user('7', ['7/likes'])),
+                ('7__1', lambda: self.cache.invalidate_fields('7', ['name']))]:
+            gen = self.fill(key, key + '\0x')
+            self.cache.store(key, key + '\0x', gen, *RESPONSE)
+            invalidate()
+            self.assertEqual(self.cache.lookup(key, key + '\0x')[0], None)
+
+    def test_invalidation_during_fetch(self):
+        gen = self.fill('7__1', '7__1\0x')
+        self.cache.invalidate_user('7')  # lands while the fetch is running
+        self.cache.store('7__1', '7__1\0x', gen, *RESPONSE)
+        self.assertEqual(self.cache.lookup('7__1', '7__1\0x')[0], None)
+
+    def test_other_paths_survive(self):
+        gen = self.fill('7/likes__1', '7/likes__1\0x')
+        self.cache.store('7/likes__1', '7/likes__1\0x', gen, *RESPONSE)
+        self.cache.invalidate_user('7', ['7'])
+        self.assertEqual(self.cache.lookup('7/likes__1', '7/likes__1\0x')[0],
+                         RESPONSE)
+
+
+if __name__ == '__main__':
+    unittest.main()
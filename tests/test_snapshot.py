@@ -0,0 +1,65 @@
+#
+# Copyright 2010 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tests for cache snapshots."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from fbproxy import snapshot
+from fbproxy.apps import App
+from fbproxy.cache import ProxyLruCache
+from fbproxy.hashdict import HashedDictionary
+
+TABLE = ('200 OK', [], {u'id': u'7', u'name': u'a'})
+
+
+class MaxAgeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+        self.appdict = {'1': App({'app_id': '1',
+                                  'whitelist_fields': ['name']})}
+        cache = ProxyLruCache(10)
+        hashdict = HashedDictionary()
+        hashdict.store('7__', 'body', lambda: TABLE)
+        hashdict.created = time.time() - 3600  # cached long ago
+        cache.shared.insert('7__1', hashdict)
+        snapshot.Snapshotter(self.path, cache, self.appdict).write()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def restored(self):
+        snap = snapshot.Snapshot(self.path, self.appdict, 600)
+        try:
+            return snap.keys()
+        finally:
+            snap.close()
+
+    def test_old_entries_of_recent_snapshot(self):
+        self.assertEqual(self.restored(), ['7__1'])
+
+    def test_old_snapshot(self):
+        out = open(self.path, 'r+b')
+        out.write(snapshot.HEADER.pack(snapshot.MAGIC, snapshot.VERSION,
+                                       time.time() - 601))
+        out.close()
+        self.assertEqual(self.restored(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()